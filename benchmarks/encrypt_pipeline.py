@@ -0,0 +1,108 @@
+#! /usr/bin/env python
+"""
+Compare the streaming encrypt pipeline against the previous implementation,
+which wrote sesame.tar into a temp directory and read it back to compress it.
+The indexed layout written by sesame e is reported alongside.
+
+Each run writes a new archive; encrypting over an existing archive would reuse
+its unchanged content, and measure re-encrypting rather than encrypting.
+
+    $ python benchmarks/encrypt_pipeline.py --files 1000 --size 4096
+"""
+import argparse
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sesame.core import encrypt
+from sesame.core import encrypt_stream
+from sesame.utils import create_key
+from sesame.utils import make_secure_temp_directory
+
+
+def encrypt_via_tempfile(inputfiles, outputfile, keys):
+    """
+    The encrypt pipeline from Sesame 0.3: tar to disk, read back, encrypt
+    """
+    with make_secure_temp_directory() as working_dir:
+        with tarfile.open(os.path.join(working_dir, 'sesame.tar'), 'w') as tar:
+            for name in inputfiles:
+                tar.add(name)
+
+        with open(os.path.join(working_dir, 'sesame.tar'), 'rb') as i:
+            with open(outputfile, 'wb') as o:
+                o.write(keys[0].Encrypt(zlib.compress(i.read())))
+
+
+def encrypt_via_stream(inputfiles, outputfile, keys):
+    with open(outputfile, 'wb') as o:
+        encrypt_stream(inputfiles, o, keys)
+
+
+def make_files(directory, count, size):
+    names = []
+    for n in range(count):
+        name = os.path.join('{0:03d}'.format(n % 100), 'file{0}.conf'.format(n))
+        path = os.path.join(directory, name)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            # half random, half repetitive; roughly config-file compressible
+            f.write(os.urandom(size // 2).encode('hex')[:size // 2] + 'x' * (size - size // 2))
+        names.append(name)
+    return names
+
+
+def timed(fn, repeat, inputfiles, outputfile, keys):
+    best = None
+    for _ in range(repeat):
+        if os.path.exists(outputfile):
+            os.remove(outputfile)
+
+        start = time.time()
+        fn(inputfiles, outputfile, keys)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, nargs='+', default=[10, 100, 1000, 5000])
+    parser.add_argument('--size', type=int, default=4096, help='Bytes per file')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    key = create_key(None, write=False)
+
+    print '{0:>8} {1:>12} {2:>12} {3:>8} {4:>12}'.format(
+        'files', 'tempfile s', 'stream s', 'speedup', 'indexed s'
+    )
+
+    for count in args.files:
+        working_dir = tempfile.mkdtemp()
+        saved_path = os.getcwd()
+        try:
+            os.chdir(working_dir)
+            names = make_files(working_dir, count, args.size)
+
+            old = timed(encrypt_via_tempfile, args.repeat, names, 'old.encrypted', [key])
+            stream = timed(encrypt_via_stream, args.repeat, names, 'stream.encrypted', [key])
+            indexed = timed(encrypt, args.repeat, names, 'indexed.encrypted', [key])
+
+            print '{0:>8} {1:>12.4f} {2:>12.4f} {3:>7.2f}x {4:>12.4f}'.format(
+                count, old, stream, old / stream, indexed
+            )
+        finally:
+            os.chdir(saved_path)
+            shutil.rmtree(working_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#! /usr/bin/env python
+"""
+Measure the cost of finding the right key among N candidates (--try-all), for
+chunked archives and the single-ciphertext format from Sesame 0.3.
+
+The right key is always the last candidate. For chunked archives the cost of
+selecting the key from the header alone is also reported: candidates are
+matched against the recipients' fingerprints, and only the right key's entry
+is unwrapped.
+
+    $ python benchmarks/key_selection.py --keys 1 10 50 --sizes 1 16
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sesame import archive
+from sesame.core import open_decrypted
+from sesame.utils import create_key
+
+
+def legacy_encrypt(path, key):
+    with open(path, 'rb') as i:
+        data = key.Encrypt(zlib.compress(i.read()))
+    with open(path + '.legacy', 'wb') as o:
+        o.write(data)
+    return path + '.legacy'
+
+
+def chunked_encrypt(path, key):
+    with open(path, 'rb') as i:
+        with open(path + '.chunked', 'wb') as o:
+            writer = archive.ChunkWriter(o, key)
+            shutil.copyfileobj(i, writer, writer.chunk_size)
+            writer.close()
+    return path + '.chunked'
+
+
+def legacy_try_all(path, keys):
+    """
+    The --try-all loop from Sesame 0.3: full decrypt per key, re-reading the file
+    """
+    for key in keys:
+        try:
+            with open(path, 'rb') as i:
+                return zlib.decompress(key.Decrypt(i.read()))
+        except Exception:
+            continue
+
+
+def chunked_try_all(path, keys):
+    with open(path, 'rb') as i:
+        stream = open_decrypted(i, keys, try_all=True)
+        while stream.read(archive.CHUNK_SIZE):
+            pass
+
+
+def header_select(path, keys):
+    """
+    Select the key from the archive header, as decrypt does before reading any
+    of the payload
+    """
+    with open(path, 'rb') as i:
+        assert archive.select_key(i, keys) is keys[-1]
+
+
+def timed(fn, *args):
+    start = time.time()
+    fn(*args)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--keys', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 16, 64], help='Archive sizes in MB')
+    args = parser.parse_args()
+
+    keys = [create_key(None, write=False) for _ in range(max(args.keys))]
+
+    print '{0:>6} {1:>8} {2:>12} {3:>12} {4:>16}'.format(
+        'keys', 'MB', 'legacy s', 'chunked s', 'select key us'
+    )
+
+    working_dir = tempfile.mkdtemp()
+    try:
+        for size in args.sizes:
+            path = os.path.join(working_dir, 'payload')
+            with open(path, 'wb') as f:
+                for _ in range(size):
+                    f.write(os.urandom(512 * 1024).encode('hex'))
+
+            for count in args.keys:
+                candidates = keys[:count]
+                legacy = legacy_encrypt(path, candidates[-1])
+                chunked = chunked_encrypt(path, candidates[-1])
+
+                print '{0:>6} {1:>8} {2:>12.4f} {3:>12.4f} {4:>16.1f}'.format(
+                    count, size,
+                    timed(legacy_try_all, legacy, candidates),
+                    timed(chunked_try_all, chunked, candidates),
+                    timed(header_select, chunked, candidates) * 1000000,
+                )
+    finally:
+        shutil.rmtree(working_dir)
+
+
+if __name__ == '__main__':
+    main()
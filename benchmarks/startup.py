@@ -0,0 +1,97 @@
+#! /usr/bin/env python
+"""
+Measure CLI startup: the time to import sesame.cli, and the wall time of
+`sesame --version`, each in a fresh interpreter.
+
+Results can be written as JSON and tracked across releases.
+
+    $ python benchmarks/startup.py --runs 20 --json startup.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+sys.path.insert(0, ROOT)
+
+import sesame
+
+IMPORT_SCRIPT = '''
+import sys, time
+start = time.time()
+import sesame.cli
+sys.stdout.write('{0!r} {1}'.format(time.time() - start, len(sys.modules)))
+'''
+
+
+def import_time():
+    """
+    Return (seconds, number of modules loaded) to import sesame.cli
+    """
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT], env=environ())
+    seconds, modules = output.split()
+    return float(seconds), int(modules)
+
+
+def version_time():
+    """
+    Return the wall time in seconds of scripts/sesame --version
+    """
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        subprocess.check_call(
+            [sys.executable, os.path.join(ROOT, 'scripts', 'sesame'), '--version'],
+            stdout=devnull, stderr=devnull, env=environ(),
+        )
+        return time.time() - start
+
+
+def environ():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+    return env
+
+
+def summarise(samples):
+    samples = sorted(samples)
+    return {
+        'min': samples[0],
+        'median': samples[len(samples) // 2],
+        'max': samples[-1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--json', metavar='PATH', help='Also write results as JSON to PATH')
+    args = parser.parse_args()
+
+    imports = [import_time() for _ in range(args.runs)]
+    versions = [version_time() for _ in range(args.runs)]
+
+    results = {
+        'sesame': sesame.__version__,
+        'python': sys.version.split()[0],
+        'runs': args.runs,
+        'import_ms': summarise([seconds * 1000 for seconds, _ in imports]),
+        'import_modules': imports[0][1],
+        'version_ms': summarise([seconds * 1000 for seconds in versions]),
+    }
+
+    print '{0:>20} {1:>10} {2:>10} {3:>10}'.format('', 'min ms', 'median ms', 'max ms')
+    for name in ('import_ms', 'version_ms'):
+        print '{0:>20} {1[min]:>10.1f} {1[median]:>10.1f} {1[max]:>10.1f}'.format(name, results[name])
+    print '{0:>20} {1:>10}'.format('modules imported', results['import_modules'])
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, separators=(',', ': '), sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
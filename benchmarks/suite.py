@@ -0,0 +1,301 @@
+#! /usr/bin/env python
+"""
+Benchmark encrypt, decrypt and key discovery across payload sizes, file counts,
+key counts and compressible or random data.
+
+Each case runs in a fresh interpreter, so the peak RSS reported is that case's
+alone. Results can be written as JSON, and compared with an earlier run to find
+regressions.
+
+    $ python benchmarks/suite.py --sizes 1 1024 65536 --files 1 100 --json run.json
+    $ python benchmarks/suite.py --compare baseline.json
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+sys.path.insert(0, ROOT)
+
+import sesame
+
+BLOCK_SIZE = 1024 * 1024
+
+WORDS = (
+    'host port user password database timeout debug secret token region bucket '
+    'true false none localhost production staging = : [ ] { } 0 1 8080 5432 3600'
+).split()
+
+
+def compressible_block(seed=0):
+    """
+    A block of config-like text, which compresses to roughly a quarter
+    """
+    rand = random.Random(seed)
+    lines = []
+    size = 0
+    while size < BLOCK_SIZE:
+        line = ' '.join(rand.choice(WORDS) for _ in range(rand.randint(2, 8)))
+        line += ' {0:08x}\n'.format(rand.getrandbits(32))
+        lines.append(line)
+        size += len(line)
+    return ''.join(lines)[:BLOCK_SIZE]
+
+
+def make_payload(directory, size_kb, files, data):
+    """
+    Write size_kb of data split evenly over files, returning the input names
+    """
+    block = compressible_block() if data == 'compressible' else None
+    per_file = max(size_kb * 1024 // files, 1)
+
+    names = []
+    for n in range(files):
+        name = os.path.join('{0:03d}'.format(n % 100), 'file{0}.conf'.format(n))
+        path = os.path.join(directory, name)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with open(path, 'wb') as f:
+            remaining = per_file
+            while remaining > 0:
+                size = min(remaining, BLOCK_SIZE)
+                f.write(block[:size] if block is not None else os.urandom(size))
+                remaining -= size
+        names.append(name)
+    return sorted(set(name.split(os.sep)[0] for name in names))
+
+
+def make_keys(directory, count):
+    from sesame.utils import create_key
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    paths = []
+    for n in range(count):
+        path = os.path.join(directory, 'key{0:04d}.key'.format(n))
+        if not os.path.exists(path):
+            with open(path, 'w') as f:
+                f.write(str(create_key(None, write=False)))
+        paths.append(path)
+    return paths
+
+
+def run_case(case):
+    """
+    Run a single case in this process; called in a fresh interpreter
+    """
+    from sesame.core import decrypt
+    from sesame.core import encrypt
+    from sesame.utils import KeyHandle
+    from sesame.utils import find_sesame_keys
+
+    os.chdir(case['cwd'])
+    start = time.time()
+
+    if case['op'] == 'encrypt':
+        encrypt(
+            inputfiles=case['inputs'],
+            outputfile=case['archive'],
+            keys=[KeyHandle(case['keys'][-1])],
+            jobs=case['jobs'],
+        )
+
+    elif case['op'] == 'decrypt':
+        decrypt(
+            inputfile=case['archive'],
+            keys=[KeyHandle(path) for path in case['keys']],
+            output_dir=case['output_dir'],
+            force=True,
+            try_all=len(case['keys']) > 1,
+            jobs=case['jobs'],
+        )
+
+    elif case['op'] == 'discover':
+        keys = find_sesame_keys([str(case['cwd'])])
+        assert len(keys) == len(case['keys'])
+
+    elapsed = time.time() - start
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes on OSX, KB elsewhere
+        peak_rss //= 1024
+
+    return {'seconds': elapsed, 'peak_rss_kb': peak_rss}
+
+
+def spawn_case(case, env=None):
+    """
+    Run a case in a fresh interpreter, returning its timing and peak RSS
+    """
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--run-case', json.dumps(case)],
+        env=dict(os.environ, **(env or {})),
+    )
+    return json.loads(output)
+
+
+def run_suite(args, working_dir):
+    results = []
+    env = {'SESAME_KEY_CACHE': ''}
+
+    key_paths = make_keys(os.path.join(working_dir, 'keys'), max(args.keys))
+
+    # throughput over payload size, file count and data
+    for size_kb, files, data in itertools.product(args.sizes, args.files, args.data):
+        if files > size_kb * 1024:
+            continue
+
+        case_dir = tempfile.mkdtemp(dir=working_dir)
+        inputs = make_payload(case_dir, size_kb, files, data)
+        params = {'size_kb': size_kb, 'files': files, 'keys': 1, 'data': data}
+
+        case = {
+            'cwd': case_dir,
+            'inputs': inputs,
+            'archive': os.path.join(case_dir, 'bench.encrypted'),
+            'output_dir': tempfile.mkdtemp(dir=working_dir),
+            'keys': key_paths[:1],
+            'jobs': args.jobs,
+        }
+        for op in ('encrypt', 'decrypt'):
+            results.append(dict(params, op=op, **spawn_case(dict(case, op=op), env)))
+
+        shutil.rmtree(case_dir)
+        shutil.rmtree(case['output_dir'])
+
+    # decrypt with many candidate keys, and discovering them
+    size_kb = min(args.sizes)
+    for count in args.keys:
+        case_dir = tempfile.mkdtemp(dir=working_dir)
+        inputs = make_payload(case_dir, size_kb, 1, 'compressible')
+        keys_dir = os.path.join(case_dir, 'keys')
+        candidates = make_keys(keys_dir, count)
+        params = {'size_kb': size_kb, 'files': 1, 'keys': count, 'data': 'compressible'}
+
+        case = {
+            'cwd': case_dir,
+            'inputs': inputs,
+            'archive': os.path.join(case_dir, 'bench.encrypted'),
+            'output_dir': tempfile.mkdtemp(dir=working_dir),
+            'keys': candidates,
+            'jobs': args.jobs,
+        }
+        spawn_case(dict(case, op='encrypt'), env)
+        results.append(dict(params, op='try-all', **spawn_case(dict(case, op='decrypt'), env)))
+
+        # discovery without the cache, then with a warm cache
+        cache = {'SESAME_KEY_CACHE': os.path.join(case_dir, 'keys.json')}
+        results.append(dict(params, op='discover', **spawn_case(dict(case, op='discover'), env)))
+        spawn_case(dict(case, op='discover'), cache)
+        results.append(dict(params, op='discover-cached', **spawn_case(dict(case, op='discover'), cache)))
+
+        shutil.rmtree(case_dir)
+        shutil.rmtree(case['output_dir'])
+
+    for result in results:
+        if result['op'].startswith('discover'):
+            result['mb_per_s'] = None
+        else:
+            result['mb_per_s'] = (result['size_kb'] / 1024.0) / max(result['seconds'], 1e-9)
+
+    return results
+
+
+def case_name(result):
+    return '{op}/{size_kb}KB/{files}f/{keys}k/{data}'.format(**result)
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the change in wall time from baseline for each case, returning the
+    names of those slower by more than threshold
+    """
+    previous = dict((case_name(result), result) for result in baseline['results'])
+
+    regressions = []
+    print
+    print '{0:<45} {1:>10} {2:>10} {3:>8}'.format('vs baseline', 'before s', 'after s', 'change')
+    for result in results:
+        name = case_name(result)
+        if name not in previous:
+            continue
+
+        before, after = previous[name]['seconds'], result['seconds']
+        change = (after - before) / max(before, 1e-9)
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = ' !'
+        print '{0:<45} {1:>10.4f} {2:>10.4f} {3:>+7.0%}{4}'.format(name, before, after, change, flag)
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 1024, 16384],
+                        help='Payload sizes in KB')
+    parser.add_argument('--files', type=int, nargs='+', default=[1, 100],
+                        help='Number of files the payload is split over')
+    parser.add_argument('--keys', type=int, nargs='+', default=[1, 10, 50],
+                        help='Number of candidate keys for --try-all and discovery')
+    parser.add_argument('--data', nargs='+', default=['compressible', 'random'],
+                        choices=['compressible', 'random'])
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--json', metavar='PATH', help='Write results as JSON to PATH')
+    parser.add_argument('--compare', metavar='PATH', help='Compare with results from an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Fractional slowdown reported as a regression (default 0.2)')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        sys.stdout.write(json.dumps(run_case(json.loads(args.run_case))))
+        return
+
+    working_dir = tempfile.mkdtemp()
+    try:
+        results = run_suite(args, working_dir)
+    finally:
+        shutil.rmtree(working_dir)
+
+    print '{0:<45} {1:>10} {2:>10} {3:>12}'.format('case', 'wall s', 'MB/s', 'peak RSS KB')
+    for result in results:
+        print '{0:<45} {1[seconds]:>10.4f} {2:>10} {1[peak_rss_kb]:>12}'.format(
+            case_name(result), result,
+            '-' if result['mb_per_s'] is None else '{0:.2f}'.format(result['mb_per_s']),
+        )
+
+    run = {
+        'sesame': sesame.__version__,
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'jobs': args.jobs,
+        'results': results,
+    }
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(run, f, indent=2, separators=(',', ': '), sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            sys.exit('{0} case(s) slower than baseline'.format(len(regressions)))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,8 +3,8 @@
 #
 
 __title__ = 'sesame'
-__version__ = '0.3.3'
-__build__ = 0x000033
+__version__ = '0.4.0'
+__build__ = 0x000040
 __author__ = 'Matt Black'
 __license__ = 'Simplified BSD License'
 __copyright__ = 'Copyright 2014 Matt Black'
@@ -12,6 +12,21 @@ __copyright__ = 'Copyright 2014 Matt Black'
 
 MODE_ENCRYPT = 1
 MODE_DECRYPT = 2
+MODE_BUILD = 3
+MODE_LIST = 4
+MODE_AGENT = 5
+MODE_REKEY = 6
 
 class SesameError(Exception):
     pass
+
+
+def load(path, key=None, cache=True, jobs=1):
+    """
+    Decrypt an archive into a read-only mapping of member name => file content
+
+    See sesame.core.load
+    """
+    # imported here so that importing sesame stays cheap
+    from .core import load
+    return load(path, key=key, cache=cache, jobs=jobs)
@@ -0,0 +1,305 @@
+from __future__ import absolute_import
+
+import collections
+import errno
+import json
+import os
+import signal
+import socket
+import SocketServer
+import stat
+import struct
+import sys
+import tempfile
+import threading
+
+from keyczar.errors import InvalidSignatureError
+from keyczar.errors import KeyczarError
+
+from . import SesameError
+from . import MODE_ENCRYPT
+
+
+# path of the agent's socket; when set, the CLI uses the agent's keys
+AGENT_ENV = 'SESAME_AGENT_SOCK'
+
+# each message is a frame of (JSON header length, payload length), then the JSON
+# header, then the binary payload
+_FRAME = struct.Struct('>II')
+
+# largest header accepted; payloads are bounded by the archive chunk size
+MAX_HEADER = 64 * 1024
+MAX_PAYLOAD = 64 * 1024 * 1024
+
+
+def get_socket_path():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'sesame', 'agent.sock')
+    return os.path.join(tempfile.gettempdir(), 'sesame-{0}'.format(os.getuid()), 'agent.sock')
+
+
+def send_message(sock, header, payload=''):
+    data = json.dumps(header)
+    sock.sendall(_FRAME.pack(len(data), len(payload)) + data)
+    if len(payload) > 0:
+        sock.sendall(payload)
+
+
+def recv_message(sock):
+    """
+    Read a single message, returning (header, payload), or None if the
+    connection was closed between messages
+    """
+    frame = _recv_exactly(sock, _FRAME.size, eof_ok=True)
+    if frame is None:
+        return None
+
+    header_length, payload_length = _FRAME.unpack(frame)
+    if header_length > MAX_HEADER or payload_length > MAX_PAYLOAD:
+        raise SesameError('Agent message too large')
+
+    try:
+        header = json.loads(_recv_exactly(sock, header_length))
+    except ValueError:
+        raise SesameError('Agent message is corrupt')
+
+    return header, _recv_exactly(sock, payload_length)
+
+
+def _recv_exactly(sock, size, eof_ok=False):
+    parts = []
+    remaining = size
+    while remaining > 0:
+        data = sock.recv(min(remaining, 1024 * 1024))
+        if not data:
+            if eof_ok and remaining == size:
+                return None
+            raise SesameError('Agent connection closed')
+        parts.append(data)
+        remaining -= len(data)
+    return ''.join(parts)
+
+
+class Agent(object):
+    """
+    Holds parsed keys in memory and performs key operations on them
+
+    Key material never leaves the agent; clients send data to be encrypted or
+    decrypted with a key named by its fingerprint. For archives this is only
+    each archive's data key.
+    """
+    def __init__(self, keys):
+        # fingerprint => (path, key)
+        self.keys = collections.OrderedDict(
+            (key.hash_id, (os.path.realpath(path), key)) for path, key in keys
+        )
+
+    def handle(self, header, payload):
+        """
+        Perform the operation in a request, returning (header, payload)
+        """
+        op = header.get('op')
+
+        if op == 'keys':
+            return {'keys': [
+                {'hash_id': hash_id, 'path': path} for hash_id, (path, key) in self.keys.items()
+            ]}, ''
+
+        if header.get('key') not in self.keys:
+            return {'error': 'Key {0} is not held by the agent'.format(header.get('key'))}, ''
+        path, key = self.keys[header['key']]
+
+        try:
+            if op == 'encrypt':
+                return {}, key.Encrypt(payload)
+            elif op == 'decrypt':
+                return {}, key.Decrypt(payload)
+
+        except InvalidSignatureError:
+            return {'error': 'invalid signature', 'signature': True}, ''
+        except KeyczarError as e:
+            return {'error': '{0}: {1}'.format(e.__class__.__name__, e)}, ''
+
+        return {'error': 'Unknown operation {0}'.format(op)}, ''
+
+
+class _Handler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                message = recv_message(self.request)
+            except SesameError:
+                return
+            if message is None:
+                return
+
+            header, payload = self.server.agent.handle(*message)
+            send_message(self.request, header, payload)
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(socket_path, keys):
+    """
+    Create an agent serving keys, a list of (path, key), on a Unix socket
+
+    The socket is created in a directory accessible only by the current user;
+    an existing directory which anyone else could write to is refused, as they
+    could replace the socket and receive the data keys sent to the agent.
+    """
+    directory = os.path.dirname(socket_path)
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise SesameError(
+            '{0} must be a directory owned by, and only accessible to, the current user'.format(directory)
+        )
+
+    # remove a socket left by an agent which didn't exit cleanly
+    if os.path.exists(socket_path):
+        if AgentClient(socket_path).is_alive():
+            raise SesameError('An agent is already listening on {0}'.format(socket_path))
+        os.remove(socket_path)
+
+    umask = os.umask(0o177)
+    try:
+        server = _Server(socket_path, _Handler)
+    finally:
+        os.umask(umask)
+
+    server.agent = Agent(keys)
+    return server
+
+
+def serve(socket_path, keys):
+    """
+    Serve keys until interrupted or terminated, removing the socket on exit
+    """
+    server = make_server(socket_path, keys)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+class AgentClient(object):
+    """
+    Connection to an agent; each thread has its own connection, so key
+    operations can be made concurrently from a thread pool
+    """
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self._local = threading.local()
+
+    def _connection(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+            except socket.error as e:
+                sock.close()
+                raise SesameError('Cannot connect to agent at {0}: {1}'.format(self.socket_path, e))
+            self._local.sock = sock
+        return sock
+
+    def call(self, op, payload='', **params):
+        """
+        Make a request of the agent, returning (header, payload)
+        """
+        params['op'] = op
+        sock = self._connection()
+        try:
+            send_message(sock, params, payload)
+            response = recv_message(sock)
+        except (socket.error, SesameError):
+            self._local.sock = None
+            sock.close()
+            raise SesameError('Lost connection to agent at {0}'.format(self.socket_path))
+
+        if response is None:
+            raise SesameError('Lost connection to agent at {0}'.format(self.socket_path))
+
+        header, payload = response
+        if header.get('signature'):
+            raise InvalidSignatureError()
+        if 'error' in header:
+            raise SesameError('Agent error: {0}'.format(header['error']))
+        return header, payload
+
+    def is_alive(self):
+        try:
+            self.call('keys')
+            return True
+        except SesameError:
+            return False
+
+    def keys(self):
+        """
+        Return an AgentKey for each key held by the agent
+        """
+        header, _ = self.call('keys')
+        return [AgentKey(self, info['hash_id'], info['path']) for info in header['keys']]
+
+
+class AgentKey(object):
+    """
+    A key held by an agent, which can be used anywhere a parsed key is expected
+    """
+    def __init__(self, client, hash_id, path):
+        self.client = client
+        self.hash_id = hash_id
+        self.path = path
+
+    def __repr__(self):
+        return '<AgentKey {0}>'.format(self.path)
+
+    def Encrypt(self, data):
+        return self.client.call('encrypt', data, key=self.hash_id)[1]
+
+    def Decrypt(self, data):
+        return self.client.call('decrypt', data, key=self.hash_id)[1]
+
+
+def select_agent_keys(keyfiles, mode):
+    """
+    Select keys held by the agent named in SESAME_AGENT_SOCK for a command
+
+    Returns None if there's no agent, or it doesn't hold every key named in
+    keyfiles, in which case keys are read from disk as usual.
+    """
+    socket_path = os.environ.get(AGENT_ENV)
+    if not socket_path:
+        return None
+
+    try:
+        keys = AgentClient(socket_path).keys()
+    except SesameError as e:
+        sys.stderr.write('{0}; not using the agent\n'.format(e))
+        return None
+
+    if len(keys) == 0:
+        return None
+
+    if keyfiles is not None:
+        keys_by_path = dict((key.path, key) for key in keys)
+        paths = [os.path.realpath(keyfile) for keyfile in keyfiles]
+        if not all(path in keys_by_path for path in paths):
+            return None
+        return [keys_by_path[path] for path in paths]
+
+    if mode == MODE_ENCRYPT and len(keys) > 1:
+        raise SesameError('The agent holds {0} keys; choose one with -k'.format(len(keys)))
+
+    # archives record their key fingerprint, so offering every key is cheap
+    return keys
@@ -0,0 +1,133 @@
+"""
+Coroutines to encrypt, decrypt and load archives from an asyncio event loop
+
+On Python 2 this requires the trollius backport of asyncio (pip install
+sesame[aio]). The work of each call, including its file I/O, is run in an
+executor so the loop is never blocked, and nothing ever prompts: files which
+exist are handled by an explicit overwrite policy.
+
+    runner = sesame.aio.Runner(limit=16)
+    tasks = [runner.decrypt(path, ['app.key'], output_dir) for path, output_dir in bundles]
+    loop.run_until_complete(trollius.gather(*tasks))
+"""
+from __future__ import absolute_import
+
+import functools
+import multiprocessing
+
+try:
+    import trollius as asyncio
+    from trollius import From
+    from trollius import Return
+except ImportError:
+    raise ImportError('sesame.aio requires the trollius package')
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import SesameError
+from . import core
+from .core import OVERWRITE_ALWAYS, OVERWRITE_ERROR, OVERWRITE_SKIP
+from .utils import KeyHandle
+
+
+class Runner(object):
+    """
+    Runs sesame operations in an executor, at most limit of them at once
+
+    limit:
+        Number of operations in progress at once (default one per CPU)
+    executor:
+        A concurrent.futures executor; by default a thread pool of limit
+        threads. With a process pool, pass keys as paths.
+    loop:
+        The event loop (default the current event loop)
+    """
+    def __init__(self, limit=None, executor=None, loop=None):
+        if limit is None:
+            limit = multiprocessing.cpu_count()
+
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = executor or ThreadPoolExecutor(max_workers=limit)
+        self._semaphore = asyncio.Semaphore(limit, loop=self.loop)
+
+    @asyncio.coroutine
+    def run(self, func, *args, **kwargs):
+        """
+        Call func in the executor once there's capacity, returning its result
+        """
+        yield From(self._semaphore.acquire())
+        try:
+            result = yield From(self.loop.run_in_executor(
+                self.executor, functools.partial(func, *args, **kwargs)
+            ))
+        finally:
+            self._semaphore.release()
+        raise Return(result)
+
+    def encrypt(self, inputfiles, outputfile, keys, jobs=1, compression=None,
+                overwrite=OVERWRITE_ERROR):
+        """
+        Coroutine to encrypt inputfiles into outputfile; see core.encrypt
+        """
+        check_policy(overwrite)
+        return self.run(
+            core.encrypt, inputfiles, outputfile, get_keys(keys),
+            jobs=jobs, compression=compression, overwrite=overwrite,
+        )
+
+    def decrypt(self, inputfile, keys, output_dir, try_all=False, jobs=1, only=None,
+                overwrite=OVERWRITE_ERROR, skip_unchanged=False):
+        """
+        Coroutine to decrypt inputfile into output_dir; see core.decrypt
+        """
+        check_policy(overwrite)
+        return self.run(
+            core.decrypt, inputfile, get_keys(keys), output_dir=output_dir,
+            try_all=try_all, jobs=jobs, only=only, overwrite=overwrite,
+            skip_unchanged=skip_unchanged,
+        )
+
+    def load(self, path, key=None, cache=True, jobs=1):
+        """
+        Coroutine to decrypt an archive into memory; see core.load
+        """
+        return self.run(core.load, path, key=key, cache=cache, jobs=jobs)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def check_policy(overwrite):
+    if overwrite not in (OVERWRITE_ALWAYS, OVERWRITE_SKIP, OVERWRITE_ERROR):
+        # asking would block a worker on stdin
+        raise SesameError('Overwrite policy must be one of always, skip or error')
+
+
+def get_keys(keys):
+    """
+    Keys may be given as paths, which are read in the executor
+    """
+    return [KeyHandle(key) if isinstance(key, basestring) else key for key in keys]
+
+
+# operations called through the module share a runner per event loop
+_runners = {}
+
+
+def get_runner(loop=None):
+    loop = loop or asyncio.get_event_loop()
+    if loop not in _runners:
+        _runners[loop] = Runner(loop=loop)
+    return _runners[loop]
+
+
+def encrypt(inputfiles, outputfile, keys, loop=None, **kwargs):
+    return get_runner(loop).encrypt(inputfiles, outputfile, keys, **kwargs)
+
+
+def decrypt(inputfile, keys, output_dir, loop=None, **kwargs):
+    return get_runner(loop).decrypt(inputfile, keys, output_dir, **kwargs)
+
+
+def load(path, key=None, loop=None, **kwargs):
+    return get_runner(loop).load(path, key=key, **kwargs)
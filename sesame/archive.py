@@ -0,0 +1,1033 @@
+from __future__ import absolute_import
+
+import bz2
+import collections
+import hashlib
+import hmac
+import json
+import mmap
+import os
+import stat
+import struct
+import zlib
+
+from multiprocessing.pool import ThreadPool
+
+from keyczar import keyczar
+from keyczar import util
+from keyczar.errors import InvalidSignatureError
+from keyczar.keys import AesKey
+
+from . import SesameError
+from . import stats
+
+
+# magic bytes which identify a chunked sesame archive; legacy archives are raw
+# keyczar ciphertext, which always begins with the keyczar version byte '\x00'
+MAGIC = 'SESAME'
+FORMAT_VERSION = 3
+
+# spaces reserved at the end of the JSON header, so the header can be rewritten
+# in place with the data key wrapped by a different key
+HEADER_RESERVE = 512
+
+# amount of plaintext compressed and encrypted as a single chunk
+CHUNK_SIZE = 1024 * 1024
+
+# chunk flags; stored inside the encrypted chunk so they are authenticated
+FLAG_LAST = 0x01
+FLAG_STORED = 0x02
+FLAG_INDEX = 0x04
+
+# archive layouts, named in the header. A stream archive is a single chunk stream
+# of a tarfile; an indexed archive holds each file's content as a separate chunk
+# stream (segment), followed by an encrypted index of members and a trailer
+LAYOUT_STREAM = 'stream'
+LAYOUT_INDEXED = 'indexed'
+
+# compression codecs which can be named in the archive header
+CODECS = ('none', 'zlib', 'bz2', 'lzma')
+DEFAULT_COMPRESSION = 'auto'
+
+# in auto mode, chunks are stored uncompressed if a fast compression of this many
+# bytes from the start of the chunk doesn't save at least a few percent
+SAMPLE_SIZE = 64 * 1024
+INCOMPRESSIBLE_RATIO = 0.95
+
+_LENGTH = struct.Struct('>I')
+_CHUNK_HEADER = struct.Struct('>QB')
+
+# index offset and length, relative to the end of the header, and the magic
+_TRAILER = struct.Struct('>QQ6s')
+
+# high bit of a chunk's length prefix marks the last chunk, so readers can stop
+# reading ahead without decrypting; it's verified against the encrypted flags
+_LAST_BIT = 0x80000000
+
+
+def is_archive(fileobj):
+    """
+    Check if fileobj contains a chunked sesame archive, leaving the file position
+    unchanged
+
+    fileobj:
+        A seekable file object positioned at the start of an encrypted file
+    """
+    pos = fileobj.tell()
+    try:
+        return fileobj.read(len(MAGIC)) == MAGIC
+    finally:
+        fileobj.seek(pos)
+
+
+def get_key_ids(fileobj):
+    """
+    Return the fingerprints (keyczar hash_id) of the keys which can decrypt
+    fileobj, leaving the file position unchanged
+
+    Chunked archives name their recipient keys in the header. Legacy archives
+    are a single keyczar ciphertext, which begins with the keyczar version byte
+    and the key's hash. An empty list is returned if no key can be identified.
+    """
+    pos = fileobj.tell()
+    try:
+        if is_archive(fileobj):
+            return [r.get('key') for r in read_header(fileobj).get('recipients', [])]
+
+        header = fileobj.read(keyczar.HEADER_SIZE)
+        if len(header) == keyczar.HEADER_SIZE and header[0] == keyczar.VERSION_BYTE:
+            return [util.Base64WSEncode(header[1:])]
+        return []
+    finally:
+        fileobj.seek(pos)
+
+
+def as_keys(key):
+    """
+    Return key as a list of keys; writers take a key or a list of them
+    """
+    return list(key) if isinstance(key, (list, tuple)) else [key]
+
+
+def new_data_key():
+    """
+    Generate a random key to encrypt the content of a single archive
+    """
+    return AesKey.Generate()
+
+
+def wrap_key(data_key, key):
+    return {'key': key.hash_id, 'data_key': util.Base64WSEncode(key.Encrypt(str(data_key)))}
+
+
+def unwrap_key(header, key):
+    """
+    Decrypt the data key in an archive header with key, finding the entry
+    wrapped for key by its fingerprint; raises InvalidSignatureError for a key
+    which isn't a recipient
+    """
+    try:
+        recipients = dict((r['key'], r['data_key']) for r in header['recipients'])
+    except (KeyError, TypeError):
+        raise SesameError('Archive header is corrupt')
+
+    if key.hash_id not in recipients:
+        raise InvalidSignatureError()
+
+    try:
+        wrapped = util.Base64WSDecode(recipients[key.hash_id])
+    except TypeError:
+        raise SesameError('Archive header is corrupt')
+
+    with stats.phase('unwrap key'):
+        data = key.Decrypt(wrapped)
+    try:
+        return AesKey.Read(data)
+    except (ValueError, KeyError):
+        raise SesameError('Archive header is corrupt')
+
+
+def write_header(fileobj, header, keys, data_key):
+    """
+    Write the archive preamble: magic, format version and a JSON header holding
+    data_key wrapped by each of keys, followed by an HMAC of the preamble made
+    with data_key
+
+    Any one of keys can decrypt the archive. The archive content is encrypted
+    with data_key, so changing the keys an archive is encrypted with only means
+    rewriting the header; see rekey_header.
+    """
+    fileobj.write(make_header(header, keys, data_key))
+
+
+def make_header(header, keys, data_key, size=None):
+    """
+    Return the bytes of an archive header; see write_header
+
+    Spaces are reserved in the header so that it can be rewritten in place; size
+    is an exact length for the header, or None if the header can't fit in it.
+    """
+    recipients = [wrap_key(data_key, key) for key in keys]
+    data = json.dumps(dict(header, recipients=recipients), sort_keys=True)
+    overhead = len(MAGIC) + 1 + _LENGTH.size + util.HLEN
+
+    if size is None:
+        size = overhead + len(data) + HEADER_RESERVE
+    elif overhead + len(data) > size:
+        return None
+    data += ' ' * (size - overhead - len(data))
+
+    preamble = MAGIC + chr(FORMAT_VERSION) + _LENGTH.pack(len(data)) + data
+    return preamble + data_key.hmac_key.Sign(preamble)
+
+
+def read_header(fileobj, key=None):
+    """
+    Read the archive preamble, returning the decoded JSON header
+
+    If key is supplied the header is authenticated against it, raising
+    InvalidSignatureError for the wrong key.
+    """
+    if key is not None:
+        return open_header(fileobj, key)[0]
+    return _read_preamble(fileobj)[1]
+
+
+def open_header(fileobj, key):
+    """
+    Read and authenticate the archive preamble, returning the decoded JSON header
+    and the archive's data key
+
+    Raises InvalidSignatureError if key can't unwrap the data key.
+    """
+    preamble, header, mac = _read_preamble(fileobj)
+    data_key = unwrap_key(header, key)
+    if not data_key.hmac_key.Verify(preamble, mac):
+        raise SesameError('Archive header is corrupt')
+    return header, data_key
+
+
+def select_key(fileobj, keys):
+    """
+    Return the first of keys which can decrypt the archive fileobj, or None,
+    leaving the file position unchanged
+
+    Keys are matched by fingerprint against the archive's recipients, and a
+    candidate is checked by unwrapping its entry for the data key. Rejecting a
+    wrong key costs decrypting a few hundred bytes, rather than any of the
+    payload.
+    """
+    pos = fileobj.tell()
+    try:
+        preamble, header, mac = _read_preamble(fileobj)
+    finally:
+        fileobj.seek(pos)
+
+    recipients = set(r.get('key') for r in header.get('recipients', []))
+
+    for key in keys:
+        if key.hash_id not in recipients:
+            continue
+        try:
+            data_key = unwrap_key(header, key)
+        except InvalidSignatureError:
+            continue
+        if data_key.hmac_key.Verify(preamble, mac):
+            return key
+    return None
+
+
+def rekey_header(fileobj, key, new_keys):
+    """
+    Return (header, length of the existing header) for the archive fileobj, where
+    header is a new header with the archive's data key, unwrapped with key,
+    wrapped for each of new_keys instead
+
+    The content of the archive is untouched by a change of keys. The new header
+    is the same length as the old if it fits, so it can be written in place.
+    Keys dropped from the archive are recorded as former recipients: they can
+    still unwrap the data key from an old copy of the archive, so it must not
+    be reused for new content.
+    """
+    fileobj.seek(0)
+    header, data_key = open_header(fileobj, key)
+    length = fileobj.tell()
+
+    new_ids = set(k.hash_id for k in new_keys)
+    former = set(header.get('former_recipients', []))
+    former.update(r['key'] for r in header['recipients'])
+    header['former_recipients'] = sorted(former - new_ids)
+
+    data = make_header(header, new_keys, data_key, size=length)
+    if data is None:
+        data = make_header(header, new_keys, data_key)
+    return data, length
+
+
+def _read_preamble(fileobj):
+    """
+    Read the archive preamble, returning (raw preamble, decoded header, HMAC)
+    """
+    preamble = fileobj.read(len(MAGIC) + 1 + _LENGTH.size)
+    if len(preamble) < len(MAGIC) + 1 + _LENGTH.size or not preamble.startswith(MAGIC):
+        raise SesameError('Not a sesame archive')
+
+    version = ord(preamble[len(MAGIC)])
+    if version != FORMAT_VERSION:
+        raise SesameError('Unsupported archive format version {0}'.format(version))
+
+    length, = _LENGTH.unpack(preamble[len(MAGIC)+1:])
+    data = fileobj.read(length)
+    mac = fileobj.read(util.HLEN)
+    if len(data) < length or len(mac) < util.HLEN:
+        raise SesameError('Archive is truncated')
+
+    try:
+        return preamble + data, json.loads(data), mac
+    except ValueError:
+        raise SesameError('Archive header is corrupt')
+
+
+def _lzma():
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            raise SesameError('lzma compression requires the backports.lzma package')
+    return lzma
+
+
+def parse_compression(spec):
+    """
+    Parse a compression spec such as 'zlib:9' into (codec, level, auto)
+
+    'auto' is zlib at the default level, storing chunks which don't compress.
+    """
+    if spec == 'auto':
+        return 'zlib', None, True
+
+    codec, _, level = spec.partition(':')
+    if codec not in CODECS:
+        raise SesameError('Unknown compression {0}; use one of auto, {1}'.format(
+            codec, ', '.join(CODECS)
+        ))
+
+    if level:
+        try:
+            level = int(level)
+        except ValueError:
+            raise SesameError('Invalid compression level {0}'.format(level))
+        if codec == 'none' or not 0 <= level <= 9:
+            raise SesameError('Invalid compression level {0} for {1}'.format(level, codec))
+    else:
+        level = None
+
+    return codec, level, False
+
+
+class Compressor(object):
+    """
+    Compresses chunk data with one of CODECS
+
+    In auto mode, a sample of each chunk is compressed first and chunks which
+    are already compressed (tarballs, images, certificate bundles) are stored
+    as they are, saving CPU on both encrypt and decrypt.
+    """
+    def __init__(self, spec=DEFAULT_COMPRESSION):
+        self.codec, self.level, self.auto = parse_compression(spec)
+
+        if self.codec == 'zlib':
+            level = zlib.Z_DEFAULT_COMPRESSION if self.level is None else self.level
+            self._compress = lambda data: zlib.compress(data, level)
+        elif self.codec == 'bz2':
+            level = 9 if self.level is None else max(self.level, 1)
+            self._compress = lambda data: bz2.compress(data, level)
+        elif self.codec == 'lzma':
+            lzma = _lzma()
+            level = 6 if self.level is None else self.level
+            self._compress = lambda data: lzma.compress(data, preset=level)
+        else:
+            self._compress = None
+
+    def compress(self, data):
+        """
+        Return (flags, data) for a chunk of plaintext
+        """
+        if self._compress is None:
+            return FLAG_STORED, data
+
+        if self.auto and is_incompressible(data):
+            return FLAG_STORED, data
+
+        compressed = self._compress(data)
+        if self.auto and len(compressed) >= len(data):
+            return FLAG_STORED, data
+        return 0, compressed
+
+
+def is_incompressible(data):
+    """
+    Guess if data is already compressed by compressing a sample of it
+    """
+    sample = data[:SAMPLE_SIZE]
+    if len(sample) == 0:
+        return False
+    return len(zlib.compress(sample, 1)) > len(sample) * INCOMPRESSIBLE_RATIO
+
+
+def get_decompressor(codec):
+    """
+    Return a function to decompress chunks written with codec
+    """
+    if codec == 'zlib':
+        return zlib.decompress
+    elif codec == 'bz2':
+        return bz2.decompress
+    elif codec == 'lzma':
+        return _lzma().decompress
+    elif codec == 'none':
+        return lambda data: data
+    raise SesameError('Archive uses unknown compression {0}'.format(codec))
+
+
+def _seal_chunk(key, seq, data, last, compressor, kind):
+    """
+    Compress and encrypt a single chunk, returning it framed with its length
+    """
+    with stats.phase('compress', len(data)):
+        flags, data = compressor.compress(data)
+    flags |= kind
+    if last:
+        flags |= FLAG_LAST
+    with stats.phase('encrypt', len(data)):
+        ciphertext = key.Encrypt(_CHUNK_HEADER.pack(seq, flags) + data)
+    return _LENGTH.pack(len(ciphertext) | (_LAST_BIT if last else 0)) + ciphertext
+
+
+def _open_chunk(key, seq, ciphertext, last, decompress, kind):
+    """
+    Decrypt, verify and decompress a single chunk
+    """
+    try:
+        with stats.phase('decrypt', len(ciphertext)):
+            plaintext = key.Decrypt(ciphertext)
+    except InvalidSignatureError:
+        if seq == 0:
+            # wrong key; let the caller try another
+            raise
+        raise SesameError('Archive is corrupt (bad signature on chunk {0})'.format(seq))
+
+    chunk_seq, flags = _CHUNK_HEADER.unpack(plaintext[:_CHUNK_HEADER.size])
+    if chunk_seq != seq or bool(flags & FLAG_LAST) != last:
+        raise SesameError('Archive is corrupt (chunk {0} out of sequence)'.format(seq))
+    if flags & FLAG_INDEX != kind:
+        raise SesameError('Archive is corrupt (chunk {0} is the wrong kind)'.format(seq))
+
+    if flags & FLAG_STORED:
+        return plaintext[_CHUNK_HEADER.size:]
+    with stats.phase('decompress') as p:
+        data = decompress(plaintext[_CHUNK_HEADER.size:])
+        p.nbytes = len(data)
+    return data
+
+
+class ChunkWriter(object):
+    """
+    File-like object which compresses and encrypts everything written to it,
+    one fixed-size chunk at a time
+
+    Each chunk is independently compressed, then encrypted and signed by keyczar.
+    The chunk's sequence number and flags are encrypted alongside the data, so
+    reordered, spliced or truncated archives are detected on decrypt.
+
+    With jobs > 1 chunks are sealed concurrently in a thread pool and written
+    out in order; at most jobs * 2 chunks are in flight at any time. A pool may
+    be shared between writers, in which case it's left running on close.
+
+    A standalone writer produces a complete stream archive, beginning with the
+    archive header, with its content encrypted by a new data key wrapped by key,
+    or by each of a list of keys. Otherwise the chunks are a segment of an
+    indexed archive, and key is that archive's data key.
+    """
+    def __init__(self, fileobj, key, chunk_size=None, jobs=1, compression=None,
+                 standalone=True, kind=0, pool=None):
+        self.fileobj = fileobj
+        self.key = key
+        self.chunk_size = chunk_size or CHUNK_SIZE
+        if isinstance(compression, Compressor):
+            self.compressor = compression
+        else:
+            self.compressor = Compressor(compression or DEFAULT_COMPRESSION)
+        self.jobs = jobs
+        self.kind = kind
+        self.seq = 0
+        self.closed = False
+        self._buffer = []
+        self._buffered = 0
+        self._pending = collections.deque()
+        self._pool = pool
+        self._own_pool = False
+
+        if self._pool is None and jobs > 1:
+            self._pool = ThreadPool(jobs)
+            self._own_pool = True
+
+        if standalone:
+            self.key = new_data_key()
+            write_header(self.fileobj, {
+                'chunk_size': self.chunk_size,
+                'codec': self.compressor.codec,
+                'layout': LAYOUT_STREAM,
+            }, as_keys(key), self.key)
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+
+        if self._buffered >= self.chunk_size:
+            data = ''.join(self._buffer)
+            offset = 0
+            while len(data) - offset >= self.chunk_size:
+                self._seal(data[offset:offset+self.chunk_size])
+                offset += self.chunk_size
+
+            self._buffer = [data[offset:]]
+            self._buffered = len(data) - offset
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            # always write a final chunk, even when empty, so truncation is detectable
+            self._seal(''.join(self._buffer), last=True)
+        finally:
+            self._buffer = []
+            self._buffered = 0
+            self.closed = True
+            if self._own_pool:
+                self._pool.terminate()
+
+    def abort(self):
+        """
+        Stop writing without a final chunk, so what was written is seen to be
+        truncated rather than mistaken for a complete archive
+        """
+        if self.closed:
+            return
+
+        self._buffer = []
+        self._buffered = 0
+        self._pending.clear()
+        self.closed = True
+        if self._own_pool:
+            self._pool.terminate()
+
+    def _seal(self, data, last=False):
+        args = (self.key, self.seq, data, last, self.compressor, self.kind)
+        if self._pool is None:
+            self._write(_seal_chunk(*args))
+        else:
+            self._pending.append(self._pool.apply_async(_seal_chunk, args))
+
+            # write out finished chunks in order, bounding the number in flight
+            while len(self._pending) > self.jobs * 2 or (last and self._pending):
+                self._write(self._pending.popleft().get())
+
+        self.seq += 1
+
+    def _write(self, data):
+        with stats.phase('write archive', len(data)):
+            self.fileobj.write(data)
+
+
+class ChunkReader(object):
+    """
+    File-like object which decrypts and decompresses an archive written by
+    ChunkWriter, holding no more than a few chunks in memory
+
+    The header is authenticated and the first chunk decrypted on construction,
+    so an InvalidSignatureError from the constructor means the key is wrong; any
+    failure after that point means the archive is damaged.
+
+    With jobs > 1 the following chunks are read ahead and opened concurrently
+    in a thread pool.
+
+    To read a segment of an indexed archive, pass the archive's header and data
+    key, and position fileobj at the start of the segment.
+    """
+    def __init__(self, fileobj, key, jobs=1, header=None, kind=0, pool=None):
+        self.fileobj = fileobj
+        if header is None:
+            header, key = open_header(self.fileobj, key)
+        self.key = key
+        self.header = header
+        self.decompress = get_decompressor(self.header.get('codec', 'zlib'))
+        self.jobs = jobs
+        self.kind = kind
+        self.seq = 0
+        self.eof = False
+        self._pending = collections.deque()
+        self._pool = None
+        self._own_pool = False
+
+        # open the first chunk immediately to verify the key
+        self._data = self._open(*self._read_chunk())
+        self._offset = 0
+
+        if pool is not None:
+            self._pool = pool
+        elif jobs > 1 and not self.eof:
+            self._pool = ThreadPool(jobs)
+            self._own_pool = True
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self._offset >= len(self._data):
+                data = self._next_chunk()
+                if data is None:
+                    break
+                self._data = data
+                self._offset = 0
+                continue
+
+            if size < 0:
+                end = len(self._data)
+            else:
+                end = min(len(self._data), self._offset + size)
+                size -= end - self._offset
+
+            parts.append(self._data[self._offset:end])
+            self._offset = end
+
+        return ''.join(parts)
+
+    def close(self):
+        if self._own_pool:
+            # let chunks in flight finish, as they may be views of a memory map
+            self._pool.close()
+            self._pool.join()
+        self._pool = None
+
+    def _open(self, seq, ciphertext, last):
+        return _open_chunk(self.key, seq, ciphertext, last, self.decompress, self.kind)
+
+    def _next_chunk(self):
+        if self._pool is None:
+            if self.eof:
+                return None
+            return self._open(*self._read_chunk())
+
+        # keep the pool busy with a bounded read-ahead
+        while not self.eof and len(self._pending) < self.jobs * 2:
+            self._pending.append(self._pool.apply_async(self._open, self._read_chunk()))
+
+        if not self._pending:
+            return None
+        return self._pending.popleft().get()
+
+    def _read_chunk(self):
+        """
+        Read the next framed chunk from the file, without decrypting it
+        """
+        with stats.phase('read archive') as p:
+            length = self.fileobj.read(_LENGTH.size)
+            if len(length) < _LENGTH.size:
+                raise SesameError('Archive is truncated')
+
+            length, = _LENGTH.unpack(length)
+            last = bool(length & _LAST_BIT)
+            length &= ~_LAST_BIT
+
+            ciphertext = read_view(self.fileobj, length)
+            if len(ciphertext) < length:
+                raise SesameError('Archive is truncated')
+            p.nbytes = _LENGTH.size + length
+
+        seq = self.seq
+        self.seq += 1
+        self.eof = last
+        return seq, ciphertext, last
+
+
+def map_file(fileobj):
+    """
+    Memory-map the whole of fileobj read-only; returns None for files which
+    can't be mapped, such as empty files and pipes
+    """
+    try:
+        return mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+        return None
+
+
+def read_view(fileobj, size=-1):
+    """
+    Read up to size bytes from fileobj, or to EOF if size is negative
+
+    From a memory map a read-only view of the mapped bytes is returned, rather
+    than a copy; views can be sliced, hashed, compressed and decrypted as-is.
+    """
+    if not isinstance(fileobj, mmap.mmap):
+        return fileobj.read(size)
+
+    pos = fileobj.tell()
+    end = len(fileobj) if size < 0 else min(pos + size, len(fileobj))
+    fileobj.seek(end)
+    return buffer(fileobj, pos, end - pos)
+
+
+def iter_blocks(fileobj, size=None):
+    """
+    Yield the content of fileobj in blocks of size bytes
+
+    Files which can be memory-mapped are yielded as views of the mapping, so
+    the content is neither copied nor read through the file object.
+    """
+    size = size or CHUNK_SIZE
+    mapped = map_file(fileobj)
+    if mapped is None:
+        while True:
+            data = fileobj.read(size)
+            if not data:
+                return
+            yield data
+
+    try:
+        for pos in xrange(0, len(mapped), size):
+            yield buffer(mapped, pos, size)
+    finally:
+        mapped.close()
+
+
+class PipeReader(object):
+    """
+    File-like wrapper for a stream which can't seek, such as a pipe on stdin
+
+    The first PEEK_SIZE bytes are buffered, so the archive can be identified and
+    keys checked against its header by seeking back to the start. Seeking is
+    otherwise unsupported, so only stream archives can be read from a pipe.
+    """
+    PEEK_SIZE = 64 * 1024
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.prefix = fileobj.read(self.PEEK_SIZE)
+        self.pos = 0
+
+    def read(self, size=-1):
+        data = ''
+        if self.pos < len(self.prefix):
+            end = len(self.prefix) if size < 0 else min(self.pos + size, len(self.prefix))
+            data = self.prefix[self.pos:end]
+            size = size if size < 0 else size - len(data)
+
+        if size != 0 and self.pos + len(data) >= len(self.prefix):
+            data += self.fileobj.read(size)
+
+        self.pos += len(data)
+        return data
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+
+        if whence == os.SEEK_END or offset != self.pos and (
+                offset > len(self.prefix) or self.pos > len(self.prefix)):
+            raise IOError('Cannot seek in a pipe')
+        self.pos = offset
+
+
+def is_indexed(fileobj):
+    """
+    Check if fileobj contains an indexed archive, leaving the file position
+    unchanged
+    """
+    pos = fileobj.tell()
+    try:
+        return is_archive(fileobj) and read_header(fileobj).get('layout') == LAYOUT_INDEXED
+    finally:
+        fileobj.seek(pos)
+
+
+def get_hash_key(key):
+    """
+    Derive the key used for member content hashes from an archive's data key
+    """
+    return hmac.new(key.hmac_key.key_bytes, 'sesame content hash', hashlib.sha256).digest()
+
+
+def content_hash(hash_key, fileobj, size=None):
+    """
+    Return the keyed hash of everything read from fileobj
+
+    The hash is keyed, so it reveals nothing about the content to anyone
+    without the archive key.
+    """
+    digest = hmac.new(hash_key, digestmod=hashlib.sha256)
+    for data in iter_blocks(fileobj, size):
+        with stats.phase('hash', len(data)):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class IndexedWriter(object):
+    """
+    Writes an indexed archive
+
+    After the header, the content of each file is written as its own chunk
+    stream (segment). Then follows an index of every member, as a chunk stream
+    of JSON, and finally a trailer giving the position of the index.
+
+    The archive can be decrypted by key, or by any one of a list of keys. Each
+    file's keyed content hash is recorded in the index. A file with the same
+    content as one already written points at that file's segment, so each
+    distinct content is stored once. If a previous archive made with the same
+    codec, and for no keys other than these (including keys it was rekeyed away
+    from), is supplied, any file whose content is unchanged has its segment
+    copied across verbatim rather than being compressed and encrypted again.
+    """
+    def __init__(self, fileobj, key, chunk_size=None, jobs=1, compression=None, previous=None):
+        self.fileobj = fileobj
+        self.keys = as_keys(key)
+        self.chunk_size = chunk_size or CHUNK_SIZE
+        self.compressor = Compressor(compression or DEFAULT_COMPRESSION)
+        self.jobs = jobs
+        self.members = []
+        self.reused = 0
+        self.deduplicated = 0
+        self._pool = ThreadPool(jobs) if jobs > 1 else None
+
+        # segments in the previous archive can only be reused if they'd decrypt
+        # identically in this one, and only by keys which can decrypt this one;
+        # keys rekeyed away from it may still hold its data key
+        self.previous = None
+        if previous is not None and previous.header['codec'] == self.compressor.codec and \
+                set(previous.recipients + previous.former_recipients) <= set(k.hash_id for k in self.keys):
+            self.previous = previous
+
+        # the previous archive's segments are encrypted with its data key
+        if self.previous is not None:
+            self.data_key = self.previous.data_key
+        else:
+            self.data_key = new_data_key()
+        self.hash_key = get_hash_key(self.data_key)
+
+        write_header(self.fileobj, {
+            'chunk_size': self.chunk_size,
+            'codec': self.compressor.codec,
+            'layout': LAYOUT_INDEXED,
+        }, self.keys, self.data_key)
+
+        # offsets are relative to the end of the header
+        self.start = self.fileobj.tell()
+
+        # segments written so far, by content hash, and the sizes of their content
+        self._segments = {}
+        self._sizes = set()
+
+    def add(self, name, path):
+        """
+        Add the file or directory at path to the archive as name
+
+        Special files, such as FIFOs and sockets, are skipped; reading them could
+        block forever, and they're never created on decrypt.
+        """
+        st = os.stat(path)
+        if not stat.S_ISDIR(st.st_mode) and not stat.S_ISREG(st.st_mode):
+            return
+
+        member = {
+            'name': name,
+            'mode': stat.S_IMODE(st.st_mode),
+            'mtime': int(st.st_mtime),
+        }
+
+        if stat.S_ISDIR(st.st_mode):
+            member['type'] = 'dir'
+        else:
+            member['type'] = 'file'
+            member['size'] = st.st_size
+            member.update(self._add_content(path, st.st_size))
+
+        self.members.append(member)
+
+    def close(self):
+        try:
+            offset = self.fileobj.tell() - self.start
+
+            writer = ChunkWriter(
+                self.fileobj, self.data_key, self.chunk_size, compression=self.compressor,
+                standalone=False, kind=FLAG_INDEX,
+            )
+            writer.write(json.dumps({'members': self.members}, sort_keys=True))
+            writer.close()
+
+            length = self.fileobj.tell() - self.start - offset
+            self.fileobj.write(_TRAILER.pack(offset, length, MAGIC))
+        finally:
+            if self._pool is not None:
+                self._pool.terminate()
+
+    def _add_content(self, path, size):
+        """
+        Write a segment for the file at path, point at an identical segment
+        already written, or copy the matching segment from the previous archive,
+        returning the member's hash, offset and length
+        """
+        offset = self.fileobj.tell() - self.start
+
+        # content is hashed up front only if it could match an existing segment
+        if self.previous is not None or size in self._sizes:
+            with open(path, 'rb') as f:
+                digest = content_hash(self.hash_key, f, self.chunk_size)
+
+            segment = self._segments.get(digest)
+            if segment is not None:
+                self.deduplicated += 1
+                return dict(segment)
+
+            segment = self.previous.find_segment(digest) if self.previous is not None else None
+            if segment is not None:
+                self.previous.copy_segment(segment, self.fileobj)
+                self.reused += 1
+                return self._add_segment(size, {
+                    'hash': digest, 'offset': offset, 'length': segment['length'],
+                })
+
+        # hash the content as it's written
+        digest = hmac.new(self.hash_key, digestmod=hashlib.sha256)
+        writer = ChunkWriter(
+            self.fileobj, self.data_key, self.chunk_size, jobs=self.jobs,
+            compression=self.compressor, standalone=False, pool=self._pool,
+        )
+        with open(path, 'rb') as f:
+            for data in iter_blocks(f, self.chunk_size):
+                with stats.phase('hash', len(data)):
+                    digest.update(data)
+                with stats.phase('read input', len(data)):
+                    data = str(data)
+                writer.write(data)
+        writer.close()
+
+        return self._add_segment(size, {
+            'hash': digest.hexdigest(),
+            'offset': offset,
+            'length': self.fileobj.tell() - self.start - offset,
+        })
+
+    def _add_segment(self, size, segment):
+        self._segments[segment['hash']] = segment
+        self._sizes.add(size)
+        return segment
+
+
+class IndexedReader(object):
+    """
+    Reads an indexed archive written by IndexedWriter
+
+    The header is authenticated and the index decrypted on construction, so an
+    InvalidSignatureError from the constructor means the key is wrong.
+    """
+    def __init__(self, fileobj, key, jobs=1):
+        self.fileobj = fileobj
+        self.key = key
+        self.jobs = jobs
+        self.header, self.data_key = open_header(self.fileobj, key)
+        self.recipients = [r['key'] for r in self.header['recipients']]
+        self.former_recipients = self.header.get('former_recipients', [])
+        self.hash_key = get_hash_key(self.data_key)
+        self.start = self.fileobj.tell()
+        self._pool = None
+
+        # locate the index from the trailer
+        self.fileobj.seek(-_TRAILER.size, os.SEEK_END)
+        offset, length, magic = _TRAILER.unpack(self.fileobj.read(_TRAILER.size))
+        if magic != MAGIC:
+            raise SesameError('Archive is truncated')
+
+        self.fileobj.seek(self.start + offset)
+        index = ChunkReader(self.fileobj, self.data_key, header=self.header, kind=FLAG_INDEX)
+        try:
+            self.members = json.loads(index.read())['members']
+        except ValueError:
+            raise SesameError('Archive index is corrupt')
+
+        self._segments = dict(
+            (member['hash'], member) for member in self.members if member['type'] == 'file'
+        )
+
+        if jobs > 1:
+            self._pool = ThreadPool(jobs)
+
+    def close(self):
+        if self._pool is not None:
+            # let chunks in flight finish, as they may be views of a memory map
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def find_segment(self, digest):
+        """
+        Return the member whose content has the keyed hash digest, or None
+        """
+        return self._segments.get(digest)
+
+    def copy_segment(self, member, fileobj):
+        """
+        Copy a member's encrypted segment verbatim into fileobj
+        """
+        with stats.phase('copy segment', member['length']):
+            self.fileobj.seek(self.start + member['offset'])
+            remaining = member['length']
+            while remaining > 0:
+                data = self.fileobj.read(min(remaining, CHUNK_SIZE))
+                if not data:
+                    raise SesameError('Archive is truncated')
+                fileobj.write(data)
+                remaining -= len(data)
+
+    def open(self, member):
+        """
+        Return a file-like object yielding the content of a file member
+
+        The content is checked against the member's keyed hash once it has all
+        been read, so a segment which has been swapped or altered is detected.
+        """
+        self.fileobj.seek(self.start + member['offset'])
+        reader = ChunkReader(
+            self.fileobj, self.data_key, jobs=self.jobs, header=self.header, pool=self._pool
+        )
+        return _VerifyingReader(reader, self.hash_key, member)
+
+
+class _VerifyingReader(object):
+    """
+    Pass reads through, raising SesameError at EOF if the keyed hash of the
+    content read doesn't match the member's
+    """
+    def __init__(self, reader, hash_key, member):
+        self.reader = reader
+        self.member = member
+        self.digest = hmac.new(hash_key, digestmod=hashlib.sha256)
+
+    def read(self, size=-1):
+        data = self.reader.read(size)
+        with stats.phase('hash', len(data)):
+            self.digest.update(data)
+
+        if not data or size < 0:
+            if not hmac.compare_digest(self.digest.hexdigest(), str(self.member['hash'])):
+                raise SesameError('Archive is corrupt (bad content hash for {0})'.format(
+                    self.member['name']
+                ))
+        return data
+
+    def close(self):
+        self.reader.close()
@@ -0,0 +1,218 @@
+from __future__ import absolute_import
+
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+
+from . import SesameError
+
+
+DEFAULT_MANIFEST = 'sesame.json'
+
+# records the inputs of each archive as it was last built, alongside the manifest
+STATE_FILE = '.sesame-build.json'
+
+BUILT = 'built'
+UP_TO_DATE = 'up to date'
+
+
+def load_manifest(path):
+    """
+    Load a build manifest, mapping each output archive to its inputs and key
+
+        {
+            "archives": {
+                "config/prod.encrypted": {
+                    "inputs": ["config/prod/*.conf", "certs/prod"],
+                    "key": "keys/prod.key",
+                    "compress": "auto"
+                }
+            }
+        }
+
+    All paths are relative to the directory containing the manifest; inputs are
+    glob patterns, and matched directories are archived recursively.
+    """
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except IOError as e:
+        raise SesameError('Problem opening manifest {0}: {1}'.format(path, e))
+    except ValueError as e:
+        raise SesameError('Manifest {0} is not valid JSON: {1}'.format(path, e))
+
+    archives = manifest.get('archives') if isinstance(manifest, dict) else None
+    if not isinstance(archives, dict) or len(archives) == 0:
+        raise SesameError('Manifest {0} defines no archives'.format(path))
+
+    for output, spec in archives.items():
+        if not spec.get('inputs'):
+            raise SesameError('No inputs for {0} in manifest'.format(output))
+        if not spec.get('key'):
+            raise SesameError('No key for {0} in manifest'.format(output))
+
+    return archives
+
+
+def build(manifest_path=DEFAULT_MANIFEST, jobs=None, force=False):
+    """
+    Build every archive in a manifest, skipping those whose inputs, key and
+    options are unchanged since they were last built
+
+    Archives are built concurrently in a pool of jobs processes, by default one
+    per CPU. Returns a list of (output, BUILT or UP_TO_DATE), sorted by output.
+
+    manifest_path:
+        Path to the JSON build manifest
+    jobs:
+        Number of archives to build in parallel
+    force:
+        Rebuild every archive, regardless of state
+    """
+    archives = load_manifest(manifest_path)
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    state_path = os.path.join(base_dir, STATE_FILE)
+
+    state = _load_state(state_path)
+
+    tasks = []
+    results = []
+    for output in sorted(archives):
+        spec = archives[output]
+        signature = _signature(base_dir, spec)
+
+        if force is False and _up_to_date(base_dir, output, state.get(output), signature):
+            results.append((output, UP_TO_DATE))
+        else:
+            tasks.append((base_dir, output, spec, signature))
+
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        try:
+            built = pool.map(_build_archive, tasks)
+        finally:
+            pool.terminate()
+    else:
+        built = [_build_archive(task) for task in tasks]
+
+    for output, signature, stat in built:
+        state[output] = {'signature': signature, 'size': stat[0], 'mtime': stat[1]}
+        results.append((output, BUILT))
+
+    _save_state(state_path, state)
+    return sorted(results)
+
+
+def _build_archive(task):
+    """
+    Encrypt a single archive from the manifest; runs in a worker process
+    """
+    # keyczar is imported by the worker only once there's an archive to build
+    from .core import encrypt
+    from .utils import mkdir_p
+    from .utils import read_key
+
+    base_dir, output, spec, signature = task
+
+    inputfiles = _expand_inputs(base_dir, spec['inputs'])
+    if len(inputfiles) == 0:
+        raise SesameError('Inputs for {0} matched no files'.format(output))
+
+    # input paths are archived relative to the manifest
+    saved_path = os.getcwd()
+    try:
+        os.chdir(base_dir)
+        mkdir_p(os.path.dirname(os.path.abspath(output)))
+
+        encrypt(
+            inputfiles=inputfiles,
+            outputfile=output,
+            keys=[read_key(spec['key'])],
+            compression=spec.get('compress'),
+        )
+
+        stat = os.stat(output)
+    finally:
+        os.chdir(saved_path)
+
+    return output, signature, (stat.st_size, stat.st_mtime)
+
+
+def _expand_inputs(base_dir, patterns):
+    """
+    Expand input glob patterns to a sorted list of paths relative to base_dir
+    """
+    paths = set()
+    for pattern in patterns:
+        for path in glob.glob(os.path.join(base_dir, pattern)):
+            paths.add(os.path.relpath(path, base_dir))
+    return sorted(paths)
+
+
+def _signature(base_dir, spec):
+    """
+    Hash the name, size and mtime of every input file and the key, along with
+    the archive's options
+    """
+    signature = hashlib.sha1(json.dumps(
+        [spec['key'], spec.get('compress')], sort_keys=True
+    ))
+
+    files = [spec['key']]
+    for path in _expand_inputs(base_dir, spec['inputs']):
+        if os.path.isdir(os.path.join(base_dir, path)):
+            for rootdir, dirnames, filenames in os.walk(os.path.join(base_dir, path)):
+                dirnames.sort()
+                files.extend(
+                    os.path.relpath(os.path.join(rootdir, filename), base_dir)
+                    for filename in sorted(filenames)
+                )
+        else:
+            files.append(path)
+
+    for path in files:
+        try:
+            stat = os.stat(os.path.join(base_dir, path))
+            signature.update('{0}\0{1}\0{2!r}\0'.format(path, stat.st_size, stat.st_mtime))
+        except OSError:
+            signature.update('{0}\0missing\0'.format(path))
+
+    return signature.hexdigest()
+
+
+def _up_to_date(base_dir, output, previous, signature):
+    """
+    An output is up to date if its inputs match the signature recorded when it
+    was last built, and the output itself hasn't been changed since
+    """
+    if previous is None or previous.get('signature') != signature:
+        return False
+
+    try:
+        stat = os.stat(os.path.join(base_dir, output))
+    except OSError:
+        return False
+
+    return previous.get('size') == stat.st_size and previous.get('mtime') == stat.st_mtime
+
+
+def _load_state(state_path):
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        state = {}
+    return state if isinstance(state, dict) else {}
+
+
+def _save_state(state_path, state):
+    fd, working_file = tempfile.mkstemp(prefix='.sesame-build-', dir=os.path.dirname(state_path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.rename(working_file, state_path)
@@ -1,19 +1,19 @@
 from __future__ import absolute_import
 
 import argparse
+import contextlib
 import os
+import stat
 import sys
 
 from . import __version__
 from . import SesameError
-from . import MODE_ENCRYPT, MODE_DECRYPT
+from . import MODE_ENCRYPT, MODE_DECRYPT, MODE_BUILD, MODE_LIST, MODE_AGENT, MODE_REKEY
 
-from .core import decrypt
-from .core import encrypt
+from .build import DEFAULT_MANIFEST
 
-from .utils import ask_overwrite
-from .utils import get_keys
-from .utils import verify_input_files
+# modules which import keyczar are imported only once a subcommand needs them,
+# so that --version, --help and usage errors return quickly
 
 
 def entrypoint():
@@ -21,17 +21,36 @@ def entrypoint():
         # setup and run argparse
         args = parse_command_line()
 
+        if args.mode == MODE_BUILD:
+            # keys are named in the build manifest
+            main(args, keys=None)
+            return
+
+        if args.mode == MODE_AGENT:
+            # the agent loads its own keys
+            main(args, keys=None)
+            return
+
+        from .utils import get_keys
+        from .utils import verify_input_files
+
+        # prompts would read from stdin, which holds the input
+        inputfiles = args.inputfile if isinstance(args.inputfile, list) else [args.inputfile]
+        if '-' in inputfiles and args.keyfile is None and not getattr(args, 'try_all', False):
+            raise SesameError('A keyfile must be supplied with -k when reading from stdin')
+
         # ensure input is good
         if verify_input_files(args.inputfile):
-            # locate encryption keys
-            keys = get_keys(args)
+            with collect_stats(args):
+                # locate encryption keys
+                keys = get_keys(args)
 
-            # check we have a key
-            if len(keys) == 0:
-                raise SesameError('No keys provided')
+                # check we have a key
+                if len(keys) == 0:
+                    raise SesameError('No keys provided')
 
-            # run encrypt/decrypt
-            main(args, keys)
+                # run encrypt/decrypt
+                main(args, keys)
 
     except SesameError as e:
         sys.stderr.write('{0}\n'.format(e))
@@ -54,8 +73,18 @@ def parse_command_line():
     # setup the arguments for both encrypt and decrypt
     parent_parser = argparse.ArgumentParser(add_help=False)
     parent_parser.add_argument(
-        '-k', '--keyfile',
-        help='Path to keyczar encryption key')
+        '-k', '--keyfile', action='append',
+        help='Path to keyczar encryption key; may be repeated to encrypt for '
+             'several keys, any of which can decrypt')
+    parent_parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='Number of chunks to compress and encrypt in parallel')
+    parent_parser.add_argument(
+        '--stats', action='store_true',
+        help='Print the time spent and bytes processed in each phase')
+    parent_parser.add_argument(
+        '--stats-json', metavar='PATH',
+        help='Write the time spent and bytes processed in each phase to PATH')
 
     # setup parser for encrypt command
     pencrypt = subparsers.add_parser('e',
@@ -65,13 +94,18 @@ def parse_command_line():
     pencrypt.set_defaults(mode=MODE_ENCRYPT)
     pencrypt.add_argument(
         'outputfile',
-        help='Encrypted file to be created')
+        help='Encrypted file to be created, or - for stdout')
     pencrypt.add_argument(
         'inputfile', nargs='+',
-        help='Files to be encrypted')
+        help='Files to be encrypted, or - to encrypt a tar stream from stdin')
     pencrypt.add_argument(
         '-f', '--force', action='store_true',
         help='Force overwrite of existing encrypted file')
+    pencrypt.add_argument(
+        '-z', '--compress', type=compression_type,
+        metavar='CODEC',
+        help='One of auto, none, zlib[:N], bz2[:N] or lzma[:N]; '
+             'auto skips data which is already compressed (default)')
 
     # setup parser for decrypt command
     pdecrypt = subparsers.add_parser('d',
@@ -81,38 +115,272 @@ def parse_command_line():
     pdecrypt.set_defaults(mode=MODE_DECRYPT)
     pdecrypt.add_argument(
         'inputfile',
-        help='File to be decrypted')
+        help='File to be decrypted, or - for stdin')
     pdecrypt.add_argument(
         '-f', '--force', action='store_true',
         help='Force overwrite of existing decrypted file')
     pdecrypt.add_argument(
         '-O', '--output-dir', default=os.getcwd(),
-        help='Extract files into a specific directory')
+        help='Extract files into a specific directory; - is the same as --raw')
+    pdecrypt.add_argument(
+        '--raw', action='store_true',
+        help='Write the decrypted tar stream to stdout instead of extracting it')
+    pdecrypt.add_argument(
+        '-T', '--try-all', action='store_true',
+        help='Search for keys from current directory and try all of them')
+    pdecrypt.add_argument(
+        '--only', nargs='+', metavar='PATH',
+        help='Extract only these files or directories from the archive')
     pdecrypt.add_argument(
+        '--skip-unchanged', action='store_true',
+        help='Leave files whose content is unchanged alone, and report the files written')
+
+    # setup parser for list command
+    plist = subparsers.add_parser('ls',
+        parents=[parent_parser],
+        help='List the contents of a file created with Sesame',
+    )
+    plist.set_defaults(mode=MODE_LIST)
+    plist.add_argument(
+        'inputfile',
+        help='File to be listed')
+    plist.add_argument(
+        '-T', '--try-all', action='store_true',
+        help='Search for keys from current directory and try all of them')
+    plist.add_argument(
+        '--json', action='store_true',
+        help='Print members as JSON')
+
+    # setup parser for build command
+    pbuild = subparsers.add_parser('build',
+        help='Encrypt every archive in a manifest which is out of date',
+    )
+    pbuild.set_defaults(mode=MODE_BUILD)
+    pbuild.add_argument(
+        '-m', '--manifest', default=DEFAULT_MANIFEST,
+        help='Path to build manifest (default {0})'.format(DEFAULT_MANIFEST))
+    pbuild.add_argument(
+        '-j', '--jobs', type=int,
+        help='Number of archives to build in parallel (default one per CPU)')
+    pbuild.add_argument(
+        '-f', '--force', action='store_true',
+        help='Rebuild all archives, even if up to date')
+
+    # setup parser for rekey command
+    prekey = subparsers.add_parser('rekey',
+        help='Change the key of archives without re-encrypting their content',
+    )
+    prekey.set_defaults(mode=MODE_REKEY, stats=False, stats_json=None)
+    prekey.add_argument(
+        'inputfile', nargs='+',
+        help='Archives to be rekeyed')
+    prekey.add_argument(
+        '-k', '--keyfile', action='append',
+        help='Path to a keyczar key the archives are encrypted with')
+    prekey.add_argument(
+        '-n', '--new-keyfile', action='append', required=True,
+        help='Path to a keyczar key to encrypt the archives for; may be repeated')
+    prekey.add_argument(
         '-T', '--try-all', action='store_true',
         help='Search for keys from current directory and try all of them')
+    prekey.add_argument(
+        '-j', '--jobs', type=int,
+        help='Number of archives to rekey in parallel (default one per CPU)')
+
+    # setup parser for agent command
+    pagent = subparsers.add_parser('agent',
+        help='Hold keys in memory and serve them to other sesame commands',
+    )
+    pagent.set_defaults(mode=MODE_AGENT)
+    pagent.add_argument(
+        '-k', '--keyfile', action='append',
+        help='Path to keyczar encryption key; may be repeated (default all keys found)')
+    pagent.add_argument(
+        '-a', '--socket',
+        help='Path of the agent socket (default $XDG_RUNTIME_DIR/sesame/agent.sock)')
 
     return parser.parse_args()
 
 
+@contextlib.contextmanager
+def collect_stats(args):
+    """
+    Collect per-phase stats for the enclosed command, if requested
+    """
+    if not args.stats and not args.stats_json:
+        yield
+        return
+
+    from . import stats
+
+    with stats.collect() as collected:
+        yield
+
+    if args.stats:
+        sys.stderr.write(collected.format())
+    if args.stats_json:
+        collected.write_json(args.stats_json)
+
+
+def compression_type(value):
+    from .archive import parse_compression
+
+    try:
+        parse_compression(value)
+    except SesameError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return value
+
+
 def main(args, keys):
     if args.mode == MODE_ENCRYPT:
+        from .core import encrypt
+        from .utils import ask_overwrite
+
+        if args.outputfile == '-':
+            check_not_terminal(sys.stdout)
+
         # check if destination exists
-        if args.force is False and os.path.exists(args.outputfile):
+        elif args.force is False and os.path.exists(args.outputfile):
             if ask_overwrite(args.outputfile) is False:
                 return
 
         encrypt(
             inputfiles=args.inputfile,
             outputfile=args.outputfile,
-            keys=keys
+            keys=keys,
+            jobs=args.jobs,
+            compression=args.compress,
+        )
+
+    elif args.mode == MODE_DECRYPT and (args.raw or args.output_dir == '-'):
+        from .core import decrypt_stream
+
+        check_not_terminal(sys.stdout)
+
+        decrypt_stream(
+            inputfile=args.inputfile,
+            fileobj=sys.stdout,
+            keys=keys,
+            try_all=args.try_all,
+            jobs=args.jobs,
+            only=args.only,
         )
 
     elif args.mode == MODE_DECRYPT:
-        decrypt(
+        from .core import decrypt
+
+        counts = decrypt(
             inputfile=args.inputfile,
             keys=keys,
             force=args.force,
             output_dir=args.output_dir,
-            try_all=args.try_all
+            try_all=args.try_all,
+            jobs=args.jobs,
+            only=args.only,
+            skip_unchanged=args.skip_unchanged,
+        )
+
+        if args.skip_unchanged:
+            sys.stdout.write('{written} written, {unchanged} unchanged, {skipped} skipped\n'.format(**counts))
+
+    elif args.mode == MODE_LIST:
+        from .core import list_members
+
+        members = list_members(
+            inputfile=args.inputfile,
+            keys=keys,
+            try_all=args.try_all,
+            jobs=args.jobs,
+        )
+
+        if args.json:
+            import json
+            json.dump(members, sys.stdout, indent=2, separators=(',', ': '), sort_keys=True)
+            sys.stdout.write('\n')
+        else:
+            for member in members:
+                sys.stdout.write(format_member(member))
+
+    elif args.mode == MODE_BUILD:
+        from .build import build
+
+        results = build(
+            manifest_path=args.manifest,
+            jobs=args.jobs,
+            force=args.force,
+        )
+
+        for output, status in results:
+            sys.stdout.write('{0}: {1}\n'.format(output, status))
+
+    elif args.mode == MODE_REKEY:
+        from .agent import select_agent_keys
+        from .core import rekey
+        from .utils import KeyHandle
+
+        new_keys = select_agent_keys(args.new_keyfile, MODE_REKEY) or [
+            KeyHandle(path) for path in args.new_keyfile
+        ]
+
+        results = rekey(
+            inputfiles=args.inputfile,
+            keys=keys,
+            new_keys=new_keys,
+            try_all=args.try_all,
+            jobs=args.jobs,
         )
+
+        for path, status in results:
+            sys.stdout.write('{0}: {1}\n'.format(path, status))
+
+    elif args.mode == MODE_AGENT:
+        from .agent import AGENT_ENV
+        from .agent import get_socket_path
+        from .agent import serve
+        from .utils import KeyHandle
+        from .utils import find_sesame_keys
+
+        if args.keyfile:
+            handles = [KeyHandle(path) for path in args.keyfile]
+        else:
+            handles = find_sesame_keys().values()
+
+        if len(handles) == 0:
+            raise SesameError('No keys found')
+
+        # parse every key up front, so commands using the agent never do
+        keys = [(handle.path, handle.key) for handle in handles]
+
+        socket_path = os.path.abspath(args.socket or get_socket_path())
+
+        # in the manner of ssh-agent, print the environment which selects this agent
+        sys.stdout.write('{0}={1}; export {0};\n'.format(AGENT_ENV, socket_path))
+        sys.stdout.flush()
+        sys.stderr.write('Agent holding {0} key(s)\n'.format(len(keys)))
+
+        try:
+            serve(socket_path, keys)
+        except KeyboardInterrupt:
+            pass
+
+
+def check_not_terminal(fileobj):
+    if fileobj.isatty():
+        raise SesameError('Refusing to write binary data to a terminal')
+
+
+def format_member(member):
+    """
+    Format a member for sesame ls, in the manner of ls -l
+    """
+    import tarfile
+
+    if member['type'] == 'dir':
+        mode = member['mode'] | stat.S_IFDIR
+    else:
+        mode = member['mode'] | stat.S_IFREG
+
+    return '{0} {1:>10} {2:<64} {3}\n'.format(
+        tarfile.filemode(mode), member['size'] or 0, member['hash'] or '-', member['name']
+    )
@@ -1,131 +1,263 @@
 from __future__ import absolute_import
 
+import collections
+import contextlib
+import filecmp
+import functools
+import hmac
+import multiprocessing
 import os
-import shutil
+import StringIO
+import sys
 import tarfile
 import tempfile
 import zlib
 
+from multiprocessing.pool import ThreadPool
+
 from keyczar.errors import KeyczarError
 from keyczar.errors import InvalidSignatureError
 
 from . import SesameError
+from . import archive
+from . import stats
+from .utils import KeyHandle
 from .utils import ask_overwrite
-from .utils import make_secure_temp_directory
+from .utils import find_sesame_keys
 from .utils import mkdir_p
 
+# member metadata reported by list_members
+MEMBER_FIELDS = ('name', 'type', 'mode', 'mtime', 'size', 'hash')
+
+# archives decrypted by load, cached for the process
+_loaded = {}
+
+# outcomes of rekey for each archive
+REKEYED = 'rekeyed'
+UP_TO_DATE = 'up to date'
+
+# outcomes of writing an output file, counted by decrypt
+WRITE_STATUSES = ('written', 'unchanged', 'skipped')
+
+# the process umask, read once at import; reading it means briefly setting it,
+# which isn't safe once other threads, such as aio workers, may be creating files
+_umask = os.umask(0)
+os.umask(_umask)
+
+# policies for a file to be written which already exists
+OVERWRITE_ASK = 'ask'
+OVERWRITE_ALWAYS = 'always'
+OVERWRITE_SKIP = 'skip'
+OVERWRITE_ERROR = 'error'
+
+
+def encrypt(inputfiles, outputfile, keys, jobs=1, compression=None, overwrite=OVERWRITE_ALWAYS):
+    """
+    Encrypt inputfiles into an indexed archive at outputfile, which any one of
+    keys can decrypt
+
+    If outputfile is already an archive made for some of the same keys, the
+    encrypted content of every file which hasn't changed is reused from it. The new archive
+    is written alongside outputfile and renamed into place.
+
+    An outputfile of '-' writes a stream archive to stdout, and inputfiles of
+    ['-'] encrypts a tar stream read from stdin; see encrypt_stream.
+
+    overwrite:
+        Policy if outputfile exists; one of the OVERWRITE_ constants
+    """
+    if outputfile == '-':
+        encrypt_stream(inputfiles, sys.stdout, keys, jobs=jobs, compression=compression)
+        sys.stdout.flush()
+        return
+
+    if check_overwrite(outputfile, overwrite) is False:
+        return
 
-def encrypt(inputfiles, outputfile, keys):
-    with make_secure_temp_directory() as working_dir:
-        # create a tarfile of inputfiles
-        with tarfile.open(os.path.join(working_dir, 'sesame.tar'), 'w') as tar:
-            for name in inputfiles:
-                # TODO use warning to prompt user here
-                if os.path.isabs(name):
-                    # fix absolute paths, same as tar does
-                    tar.add(name, arcname=name[1:])
-                elif name.startswith('..'):
-                    # skip relative paths
-                    pass
+    fd, working_file = tempfile.mkstemp(
+        prefix='.sesame-', dir=os.path.dirname(os.path.abspath(outputfile))
+    )
+    try:
+        previous = open_previous(outputfile, keys)
+        try:
+            with os.fdopen(fd, 'wb') as o:
+                if '-' in inputfiles:
+                    encrypt_stream(inputfiles, o, keys, jobs=jobs, compression=compression)
                 else:
-                    tar.add(name)
+                    writer = archive.IndexedWriter(
+                        o, keys, jobs=jobs, compression=compression, previous=previous
+                    )
+                    # the archive being written, and the one it replaces, may be
+                    # among the inputs when encrypting a directory which holds them
+                    exclude = set([working_file, os.path.abspath(outputfile)])
+                    for name, path in iter_inputs(inputfiles):
+                        if os.path.abspath(path) not in exclude:
+                            writer.add(name, path)
+                    writer.close()
+        finally:
+            if previous is not None:
+                previous.close()
+                previous.fileobj.close()
 
+        # mkstemp creates files readable only by the owner; keep the mode of the
+        # archive being replaced, or match open() for a new one
         try:
-            # encrypt the tarfile
-            with open(os.path.join(working_dir, 'sesame.tar'), 'rb') as i:
-                with open(outputfile, 'wb') as o:
-                    o.write(keys[0].Encrypt(zlib.compress(i.read())))
-        except KeyczarError as e:
-            raise SesameError(
-                'An error occurred in keyczar.Encrypt\n  {0}:{1}'.format(e.__class__.__name__, e)
-            )
+            mode = os.stat(outputfile).st_mode & 0o7777
+        except OSError:
+            mode = 0o666 & ~_umask
+        os.chmod(working_file, mode)
 
+        os.rename(working_file, outputfile)
 
-def decrypt(inputfile, keys, force=False, output_dir=None, try_all=False):
-    with make_secure_temp_directory() as working_dir:
-        # create a temporary file
-        working_file = tempfile.mkstemp(dir=working_dir)
+    except KeyczarError as e:
+        os.remove(working_file)
+        raise SesameError(
+            'An error occurred in keyczar.Encrypt\n  {0}:{1}'.format(e.__class__.__name__, e)
+        )
+    except:
+        os.remove(working_file)
+        raise
 
-        success = False
 
-        # iterate all keys; first successful key will break
-        for key in keys:
-            try:
-                # decrypt the input file
-                with open(inputfile, 'rb') as i:
-                    data = zlib.decompress(key.Decrypt(i.read()))
+def encrypt_stream(inputfiles, fileobj, keys, jobs=1, compression=None):
+    """
+    Encrypt inputfiles as a stream archive written to fileobj
 
-                # write into our working file
-                with os.fdopen(working_file[0], 'wb') as o:
-                    o.write(data)
+    A stream archive is written strictly in order, so fileobj may be a pipe; it's
+    encrypted in bounded memory. If inputfiles is ['-'], stdin is expected to
+    be a tar stream and is encrypted as it is.
+    """
+    if '-' in inputfiles and len(inputfiles) > 1:
+        raise SesameError('Input from stdin (-) cannot be combined with other files')
 
-                success = True
-                break
-            except InvalidSignatureError as e:
-                if try_all is False:
-                    raise SesameError('Incorrect key')
-            except KeyczarError as e:
-                raise SesameError(
-                    'An error occurred in keyczar.Decrypt\n  {0}:{1}'.format(
-                        e.__class__.__name__, e
-                    )
+    try:
+        writer = archive.ChunkWriter(fileobj, keys, jobs=jobs, compression=compression)
+        try:
+            if inputfiles == ['-']:
+                while True:
+                    data = sys.stdin.read(writer.chunk_size)
+                    if not data:
+                        break
+                    writer.write(data)
+            else:
+                # file symlinks are archived as the file they point to, as in
+                # an indexed archive
+                with tarfile.open(fileobj=writer, mode='w|', dereference=True) as tar:
+                    for name, path in iter_inputs(inputfiles):
+                        tar.add(path, arcname=name, recursive=False)
+        except:
+            # a failed encrypt mustn't leave an archive which looks complete
+            writer.abort()
+            raise
+        writer.close()
+
+    except KeyczarError as e:
+        raise SesameError(
+            'An error occurred in keyczar.Encrypt\n  {0}:{1}'.format(e.__class__.__name__, e)
+        )
+
+
+def iter_inputs(inputfiles):
+    """
+    Yield (archive name, path) for each of inputfiles, recursing into directories
+    in the same manner as tar
+    """
+    for name in inputfiles:
+        # TODO use warning to prompt user here
+        if os.path.isabs(name):
+            # fix absolute paths, same as tar does
+            arcname = name[1:]
+        elif name.startswith('..'):
+            # skip relative paths
+            continue
+        else:
+            arcname = name
+
+        arcname = os.path.normpath(arcname)
+        yield arcname, name
+
+        if os.path.isdir(name) and not os.path.islink(name):
+            for rootdir, dirnames, filenames in os.walk(name):
+                # symlinked directories are not followed
+                dirnames[:] = sorted(
+                    dirname for dirname in dirnames
+                    if not os.path.islink(os.path.join(rootdir, dirname))
                 )
 
-        # check failure
-        if success is False:
-            raise SesameError('No valid keys for decryption')
-
-        if tarfile.is_tarfile(working_file[1]):
-            # untar the decrypted temp file
-            with tarfile.open(working_file[1], 'r') as tar:
-                def is_within_directory(directory, target):
-                    
-                    abs_directory = os.path.abspath(directory)
-                    abs_target = os.path.abspath(target)
-                
-                    prefix = os.path.commonprefix([abs_directory, abs_target])
-                    
-                    return prefix == abs_directory
-                
-                def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-                
-                    for member in tar.getmembers():
-                        member_path = os.path.join(path, member.name)
-                        if not is_within_directory(path, member_path):
-                            raise Exception("Attempted Path Traversal in Tar File")
-                
-                    tar.extractall(path, members, numeric_owner=numeric_owner) 
-                    
-                
-                safe_extract(tar, path=working_dir)
-
-            # get list of full paths to all files in working dir
-            # ignoring the decrypted tarfile
-            working_items = [
-                os.path.join(rootdir[len(working_dir)+1:], filename)
-                for rootdir, dirnames, filenames in os.walk(working_dir)
-                for filename in filenames if filename != os.path.basename(working_file[1])
-            ]
+                for filename in dirnames + sorted(filenames):
+                    path = os.path.join(rootdir, filename)
+                    if os.path.exists(path):
+                        yield os.path.join(arcname, os.path.relpath(path, name)), path
+
+
+def open_previous(outputfile, keys):
+    """
+    Open the existing archive at outputfile so its segments can be reused, if
+    it's an indexed archive which one of keys can read; otherwise return None
+    """
+    try:
+        f = open(outputfile, 'rb')
+    except IOError:
+        return None
+
+    try:
+        key = archive.select_key(f, keys) if archive.is_indexed(f) else None
+        if key is not None:
+            return archive.IndexedReader(f, key)
+    except (SesameError, KeyczarError):
+        # damaged archive; encrypt everything afresh
+        pass
+
+    f.close()
+    return None
+
+
+def decrypt(inputfile, keys, force=False, output_dir=None, try_all=False, jobs=1, only=None,
+            overwrite=None, skip_unchanged=False):
+    """
+    Decrypt inputfile, extracting its files into output_dir
+
+    Returns a dict counting the files written, left unchanged and skipped.
 
-            for filename in working_items:
-                # move all files to the output path
-                move_output_file(
-                    path=os.path.join(working_dir, filename),
-                    dest=os.path.join(output_dir, filename),
-                    force=force,
+    only:
+        List of member names; only these, and anything beneath a directory
+        among them, are extracted. From an indexed archive nothing else is
+        decrypted.
+    overwrite:
+        Policy for files which exist; one of the OVERWRITE_ constants. By
+        default the user is asked, or with force files are overwritten.
+    skip_unchanged:
+        Leave alone existing files whose content is the same as the archive's,
+        so their mtimes are untouched. Indexed archives are compared by size and
+        content hash without decrypting the file; otherwise the file is
+        decrypted and compared.
+    """
+    if overwrite is None:
+        overwrite = OVERWRITE_ALWAYS if force else OVERWRITE_ASK
+
+    with open_input(inputfile) as i:
+        # find a key which decrypts the input
+        with contextlib.closing(open_decrypted(i, keys, try_all, jobs=jobs)) as source:
+            members = iter_members(source, only=only)
+            if members is not None:
+                return extract_members(
+                    members, output_dir, overwrite=overwrite, skip_unchanged=skip_unchanged,
+                    hash_key=getattr(source, 'hash_key', None),
                 )
 
-        else:
             # older versions of Sesame didn't wrap a tarfile and
             # encrypted only a single file at a time
-            working_items = [os.path.join(working_dir[len(working_dir)+1:], )]
+            if only:
+                raise SesameError('Archive contains a single unnamed file')
+            source.seek(0)
 
             # attempt to create an output filename using old Sesame logic
             if inputfile.endswith(".encrypted"):
-                move_output_file(
-                    path=working_file[1],
+                status = write_output_file(
+                    source,
                     dest=os.path.join(output_dir, inputfile[0:-10]),
-                    force=force,
+                    overwrite=overwrite,
+                    skip_unchanged=skip_unchanged,
                 )
             else:
                 # create a secure random-named file
@@ -133,21 +265,646 @@ def decrypt(inputfile, keys, force=False, output_dir=None, try_all=False):
                     keyfile.write("\0")
 
                 # overwrite the file just created with the decrypted file
-                move_output_file(
-                    path=working_file[1],
+                status = write_output_file(
+                    source,
                     dest=os.path.join(output_dir, keyfile.name),
-                    force=True,
+                    overwrite=OVERWRITE_ALWAYS,
                 )
 
+            counts = dict.fromkeys(WRITE_STATUSES, 0)
+            counts[status] += 1
+            return counts
+
+
+def decrypt_stream(inputfile, fileobj, keys, try_all=False, jobs=1, only=None):
+    """
+    Decrypt inputfile, writing the tar stream it contains to fileobj rather than
+    extracting it
+
+    For an indexed archive the tar stream is built from its members as they are
+    decrypted. Memory use is bounded, so fileobj may be a pipe.
+
+    only:
+        List of member names to include; see decrypt
+    """
+    with open_input(inputfile) as i:
+        with contextlib.closing(open_decrypted(i, keys, try_all, jobs=jobs)) as source:
+            if isinstance(source, archive.IndexedReader) or only:
+                members = iter_members(source, only=only)
+                if members is None:
+                    raise SesameError('Archive contains a single unnamed file')
+                write_tar(members, fileobj)
+
+            else:
+                # copy the decrypted tar (or single file from Sesame 0.3) as-is
+                while True:
+                    data = source.read(archive.CHUNK_SIZE)
+                    if not data:
+                        break
+                    fileobj.write(data)
+
+    fileobj.flush()
+
+
+def write_tar(members, fileobj):
+    """
+    Write (member, open function) pairs to fileobj as a tar stream
+    """
+    with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+        for member, open_member in members:
+            tarinfo = tarfile.TarInfo(member['name'])
+            tarinfo.mode = member['mode']
+            tarinfo.mtime = member['mtime']
+
+            if member['type'] == 'dir':
+                tarinfo.type = tarfile.DIRTYPE
+                tar.addfile(tarinfo)
+
+            elif member['type'] == 'file':
+                tarinfo.size = member['size']
+                content = open_member()
+                tar.addfile(tarinfo, content)
+
+                # read to EOF, so the content is verified against the index
+                content.read()
+
+
+def list_members(inputfile, keys, try_all=False, jobs=1):
+    """
+    List the members of inputfile without extracting them
+
+    Returns a list of dicts of name, type, mode, mtime, size and hash (the keyed
+    content hash, None for archives without an index). For an indexed archive
+    only the index is decrypted.
+    """
+    with open_input(inputfile) as i:
+        with contextlib.closing(open_decrypted(i, keys, try_all, jobs=jobs)) as source:
+            members = iter_members(source)
+            if members is None:
+                raise SesameError('Archive contains a single unnamed file')
+
+            return [
+                dict((field, member.get(field)) for field in MEMBER_FIELDS)
+                for member, open_member in members
+            ]
+
+
+def rekey(inputfiles, keys, new_keys, try_all=False, jobs=None):
+    """
+    Change the keys each of inputfiles is encrypted for to new_keys
+
+    Only the header of each archive is rewritten, with the archive's data key
+    wrapped by each of new_keys; the content isn't decrypted. Archives are rekeyed
+    concurrently in a pool of jobs threads, by default one per CPU. Returns a
+    list of (path, REKEYED or UP_TO_DATE) in the order given.
+    """
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+
+    rekey_one = functools.partial(rekey_archive, keys=keys, new_keys=new_keys, try_all=try_all)
+
+    if jobs > 1 and len(inputfiles) > 1:
+        pool = ThreadPool(min(jobs, len(inputfiles)))
+        try:
+            statuses = pool.map(rekey_one, inputfiles)
+        finally:
+            pool.terminate()
+    else:
+        statuses = [rekey_one(path) for path in inputfiles]
+
+    return zip(inputfiles, statuses)
+
+
+def rekey_archive(path, keys, new_keys, try_all=False):
+    """
+    Rewrap the data key of the archive at path for new_keys, returning REKEYED,
+    or UP_TO_DATE if it's already encrypted for exactly new_keys
+
+    The new header is written in place, and synced, when it fits in the space
+    reserved in the existing header; otherwise the archive is rewritten
+    alongside and renamed into place, copying its content verbatim.
+    """
+    try:
+        f = open(path, 'r+b')
+    except IOError as e:
+        raise SesameError('Problem opening {0}: {1}'.format(path, e))
+
+    with f:
+        if not archive.is_archive(f):
+            raise SesameError(
+                '{0} was made by an older version of Sesame; decrypt and encrypt it to change key'.format(path)
+            )
+
+        # an archive already rekeyed is recognised, so rekey can be re-run
+        if sorted(archive.get_key_ids(f)) == sorted(k.hash_id for k in new_keys):
+            return UP_TO_DATE
+
+        try:
+            key = archive.select_key(f, list(keys) + list(new_keys))
+            if key is None:
+                raise SesameError('{0}: {1}'.format(
+                    path, 'Incorrect key' if try_all is False else 'No valid keys for decryption'
+                ))
+
+            header, length = archive.rekey_header(f, key, new_keys)
+
+        except KeyczarError as e:
+            raise SesameError(
+                'An error occurred in keyczar\n  {0}:{1}'.format(e.__class__.__name__, e)
+            )
+
+        if len(header) == length:
+            f.seek(0)
+            f.write(header)
+            f.flush()
+            os.fsync(f.fileno())
+            return REKEYED
+
+        fd, working_file = tempfile.mkstemp(prefix='.sesame-', dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, 'wb') as o:
+                o.write(header)
+                f.seek(length)
+                while True:
+                    data = f.read(archive.CHUNK_SIZE)
+                    if not data:
+                        break
+                    o.write(data)
+
+            os.chmod(working_file, os.fstat(f.fileno()).st_mode & 0o7777)
+            os.rename(working_file, path)
+        except:
+            os.remove(working_file)
+            raise
+
+    return REKEYED
+
+
+def load(path, key=None, cache=True, jobs=1):
+    """
+    Decrypt an archive into memory, for reading config at application startup
+
+    Returns a read-only mapping of member name => file content; nothing is
+    written to disk. The result is cached for the life of the process against
+    the archive's path, size and mtime, and the fingerprints of its keys.
+
+    key:
+        Path to a key file, or a key; by default keys are searched for as by
+        sesame d --try-all
+    cache:
+        Set False to always decrypt the archive afresh
+    """
+    if key is None:
+        keys, try_all = find_sesame_keys().values(), True
+    elif isinstance(key, basestring):
+        keys, try_all = [KeyHandle(key)], False
+    else:
+        keys, try_all = [key], False
+
+    if len(keys) == 0:
+        raise SesameError('No keys provided')
+
+    try:
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            key_ids = archive.get_key_ids(f)
+    except IOError as e:
+        raise SesameError('Problem opening {0}: {1}'.format(path, e))
+
+    cache_key = (os.path.realpath(path), stat.st_size, stat.st_mtime, tuple(key_ids))
+    if cache is True and cache_key in _loaded:
+        # only serve the cached contents to a holder of one of the archive's keys
+        if any(k.hash_id in key_ids for k in keys):
+            return _loaded[cache_key]
+
+    contents = Contents(read_members(path, keys, try_all=try_all, jobs=jobs))
+
+    if cache is True and len(key_ids) > 0:
+        _loaded[cache_key] = contents
+    return contents
+
+
+class Contents(collections.Mapping):
+    """
+    A read-only mapping of member name => file content
+    """
+    def __init__(self, members):
+        self._members = members
+
+    def __getitem__(self, name):
+        return self._members[name]
+
+    def __iter__(self):
+        return iter(self._members)
 
-def move_output_file(path, dest, force=False):
-    # ask user about overwrite
-    if force is False and os.path.exists(dest):
-        if ask_overwrite(dest) is False:
+    def __len__(self):
+        return len(self._members)
+
+    def __repr__(self):
+        return '<Contents {0}>'.format(self._members.keys())
+
+
+def read_members(inputfile, keys, names=None, try_all=False, jobs=1):
+    """
+    Decrypt files from inputfile into memory
+
+    Returns an OrderedDict of member name => content for each file in the
+    archive, or only those named in names (or beneath a directory in names).
+    Files with the same content hash share their content.
+    """
+    contents = collections.OrderedDict()
+    by_hash = {}
+
+    with open_input(inputfile) as i:
+        with contextlib.closing(open_decrypted(i, keys, try_all, jobs=jobs)) as source:
+            members = iter_members(source, only=names)
+            if members is None:
+                raise SesameError('Archive contains a single unnamed file')
+
+            for member, open_member in members:
+                if member['type'] == 'file':
+                    content = by_hash.get(member.get('hash'))
+                    if content is None:
+                        content = open_member().read()
+                        if member.get('hash') is not None:
+                            by_hash[member['hash']] = content
+                    contents[member['name']] = content
+
+                elif member['type'] == 'link' and member['target'] in contents:
+                    # hard links in a tarfile share their target's content
+                    contents[member['name']] = contents[member['target']]
+
+    return contents
+
+
+@contextlib.contextmanager
+def open_input(inputfile):
+    """
+    Open an archive for reading, memory-mapped where possible; an inputfile of
+    '-' reads from stdin
+
+    Chunks of a mapped archive are handed to the decrypt stages as views of the
+    mapping, without being copied or read through the file object.
+    """
+    if inputfile == '-':
+        try:
+            # stdin redirected from a file can seek
+            sys.stdin.seek(0, os.SEEK_CUR)
+            stdin = sys.stdin
+        except IOError:
+            stdin = archive.PipeReader(sys.stdin)
+        yield stdin
+        return
+
+    with open(inputfile, 'rb') as f:
+        mapped = archive.map_file(f)
+        if mapped is None:
+            yield f
             return
 
+        try:
+            yield mapped
+        finally:
+            mapped.close()
+
+
+def open_decrypted(i, keys, try_all=False, jobs=1):
+    """
+    Return an IndexedReader for an indexed archive, otherwise a file-like object
+    yielding the plaintext of encrypted file i
+
+    The key is chosen by matching the fingerprints of the archive's recipient keys
+    against the fingerprints of keys; only when the archive doesn't identify its
+    key are the keys tried in order, the first key which decrypts the input
+    being used.
+
+    Chunked archives are decrypted lazily as the stream is read; archives written
+    by older versions of Sesame are a single keyczar ciphertext and must be
+    decrypted whole.
+    """
+    chunked = archive.is_archive(i)
+
+    if chunked:
+        # choose a key by checking each against the authenticated header
+        key = archive.select_key(i, keys)
+        if key is None:
+            raise SesameError('Incorrect key' if try_all is False else 'No valid keys for decryption')
+        keys = [key]
+        indexed = archive.is_indexed(i)
+
+        if indexed and isinstance(i, archive.PipeReader):
+            raise SesameError('Indexed archives cannot be read from a pipe; read from a file instead')
+
+    else:
+        key_ids = archive.get_key_ids(i)
+        if key_ids:
+            keys = [key for key in keys if key.hash_id in key_ids][:1]
+
+        # the whole file is a single ciphertext; read it once for every key
+        i.seek(0)
+        ciphertext = archive.read_view(i)
+
+    # iterate all keys; first successful key will return
+    for key in keys:
+        try:
+            i.seek(0)
+            if chunked and indexed:
+                return archive.IndexedReader(i, key, jobs=jobs)
+            elif chunked:
+                return archive.ChunkReader(i, key, jobs=jobs)
+            else:
+                return StringIO.StringIO(zlib.decompress(key.Decrypt(ciphertext)))
+
+        except InvalidSignatureError as e:
+            if try_all is False:
+                raise SesameError('Incorrect key')
+        except KeyczarError as e:
+            raise SesameError(
+                'An error occurred in keyczar.Decrypt\n  {0}:{1}'.format(
+                    e.__class__.__name__, e
+                )
+            )
+
+    if try_all is False:
+        raise SesameError('Incorrect key')
+    raise SesameError('No valid keys for decryption')
+
+
+def iter_members(source, only=None):
+    """
+    Return an iterator of (member, open function) for the archive opened by
+    open_decrypted, or None for a single file encrypted by Sesame 0.3
+
+    only:
+        List of member names to select; see select_members
+    """
+    if isinstance(source, archive.IndexedReader):
+        members = indexed_members(source)
+    else:
+        try:
+            # read tar members directly from the decrypted stream
+            tar = tarfile.open(fileobj=source, mode='r|')
+        except tarfile.ReadError:
+            if isinstance(source, archive.ChunkReader):
+                raise SesameError('Archive is corrupt (no tarfile found)')
+            return None
+
+        members = tar_members(tar)
+
+    if only:
+        members = select_members(members, only)
+    return members
+
+
+def select_members(members, only):
+    """
+    Filter (member, open function) pairs to those named in only, or beneath a
+    directory named in only
+
+    SesameError is raised once members are exhausted if any name wasn't found.
+    """
+    found = collections.OrderedDict(
+        (os.path.normpath(name.lstrip('/')), False) for name in only
+    )
+
+    for member, open_member in members:
+        name = os.path.normpath(member['name'])
+        for wanted in found:
+            if name == wanted or name.startswith(os.path.join(wanted, '')):
+                found[wanted] = True
+                yield member, open_member
+                break
+
+    missing = [name for name, matched in found.items() if not matched]
+    if missing:
+        raise SesameError('Not found in archive: {0}'.format(', '.join(missing)))
+
+
+def indexed_members(source):
+    """
+    Yield (member, open function) for each member of an indexed archive
+    """
+    for member in source.members:
+        yield member, functools.partial(source.open, member)
+
+
+def tar_members(tar):
+    """
+    Yield (member, open function) for each member of a streamed tarfile
+    """
+    for tarinfo in tar:
+        if tarinfo.isdir():
+            kind = 'dir'
+        elif tarinfo.isfile():
+            kind = 'file'
+        elif tarinfo.islnk():
+            kind = 'link'
+        elif tarinfo.issym():
+            kind = 'symlink'
+        else:
+            kind = 'other'
+
+        member = {
+            'name': tarinfo.name,
+            'type': kind,
+            'mode': tarinfo.mode,
+            'mtime': tarinfo.mtime,
+            'size': tarinfo.size,
+        }
+        if kind in ('link', 'symlink'):
+            member['target'] = tarinfo.linkname
+        yield member, functools.partial(tar.extractfile, tarinfo)
+
+
+def extract_members(members, output_dir, overwrite=OVERWRITE_ASK, skip_unchanged=False,
+                    hash_key=None):
+    """
+    Extract each of members directly into output_dir, returning a dict counting
+    the files written, left unchanged and skipped
+
+    Members are written one at a time as they are read from the archive; each
+    member is checked for path traversal before anything is written. A file
+    with the same content hash as one already extracted is copied from it
+    rather than decrypted again.
+
+    With skip_unchanged, files whose content is already at the destination are
+    left alone; members with a content hash are compared using hash_key.
+
+    Tar streams may hold links: a hard link is written as a copy of its target,
+    which must already have been extracted, and a symlink is created only if it
+    points within output_dir. Other links, and special files, are skipped with
+    a warning.
+    """
+    counts = dict.fromkeys(WRITE_STATUSES, 0)
+
+    # files extracted, by content hash and by name
+    extracted = {}
+    names = {}
+
+    # names of symlinks created; nothing is written through them
+    symlinks = []
+
+    for member, open_member in members:
+        name = os.path.normpath(member['name'])
+        dest = os.path.join(output_dir, member['name'])
+        # an archive of '.' has a member for the output dir itself
+        if not is_within_directory(output_dir, dest, inclusive=member['type'] == 'dir') or \
+                any(name.startswith(os.path.join(link, '')) for link in symlinks):
+            raise SesameError('Attempted path traversal in archive: {0}'.format(member['name']))
+
+        if member['type'] == 'dir':
+            mkdir_p(dest)
+
+        elif member['type'] in ('file', 'link'):
+            if member['type'] == 'link':
+                source = names.get(os.path.normpath(member['target']))
+                if source is None:
+                    warn_skipped(member, 'its target was not extracted')
+                    counts['skipped'] += 1
+                    continue
+            else:
+                source = extracted.get(member.get('hash'))
+
+            if skip_unchanged and hash_key is not None and is_unchanged(dest, member, hash_key):
+                counts['unchanged'] += 1
+                names[name] = dest
+                continue
+
+            if check_overwrite(dest, overwrite) is False:
+                counts['skipped'] += 1
+                continue
+
+            if source is not None:
+                with open(source, 'rb') as f:
+                    status = write_output_file(
+                        f, dest=dest, overwrite=OVERWRITE_ALWAYS, mode=member['mode'],
+                        skip_unchanged=skip_unchanged,
+                    )
+            else:
+                status = write_output_file(
+                    open_member(), dest=dest, overwrite=OVERWRITE_ALWAYS, mode=member['mode'],
+                    skip_unchanged=skip_unchanged,
+                )
+                if member.get('hash') is not None:
+                    extracted[member['hash']] = dest
+
+            names[name] = dest
+            counts[status] += 1
+
+        elif member['type'] == 'symlink':
+            target = os.path.join(os.path.dirname(dest), member['target'])
+            if not is_within_directory(os.path.realpath(output_dir), os.path.realpath(target), inclusive=True):
+                warn_skipped(member, 'it points outside the output directory')
+                counts['skipped'] += 1
+                continue
+
+            counts[write_symlink(member['target'], dest, overwrite, skip_unchanged)] += 1
+            symlinks.append(name)
+
+        else:
+            # special files are never created on decrypt
+            warn_skipped(member, 'it is a special file')
+            counts['skipped'] += 1
+
+    return counts
+
+
+def warn_skipped(member, reason):
+    sys.stderr.write('Skipped {0}: {1}\n'.format(member['name'], reason))
+
+
+def write_symlink(target, dest, overwrite=OVERWRITE_ASK, skip_unchanged=False):
+    """
+    Create a symlink to target at dest, returning 'written', or 'unchanged' or
+    'skipped' if dest was left alone
+    """
+    if skip_unchanged and os.path.islink(dest) and os.readlink(dest) == target:
+        return 'unchanged'
+
+    if os.path.lexists(dest):
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            raise SesameError('{0} is a directory'.format(dest))
+        if check_overwrite(dest, overwrite) is False:
+            return 'skipped'
+        os.remove(dest)
+
+    mkdir_p(os.path.dirname(dest))
+    os.symlink(target, dest)
+    return 'written'
+
+
+def is_unchanged(dest, member, hash_key):
+    """
+    Return True if the file at dest has the content of member, comparing the
+    size and then the keyed content hash
+    """
+    if not os.path.isfile(dest) or os.path.getsize(dest) != member['size']:
+        return False
+
+    with open(dest, 'rb') as f:
+        digest = archive.content_hash(hash_key, f, archive.CHUNK_SIZE)
+    return hmac.compare_digest(digest, str(member['hash']))
+
+
+def check_overwrite(dest, overwrite):
+    """
+    Return True if dest may be written under the overwrite policy
+    """
+    if overwrite == OVERWRITE_ALWAYS or not os.path.exists(dest):
+        return True
+    elif overwrite == OVERWRITE_SKIP:
+        return False
+    elif overwrite == OVERWRITE_ERROR:
+        raise SesameError('{0} exists'.format(dest))
+    elif overwrite == OVERWRITE_ASK:
+        return ask_overwrite(dest)
+    raise SesameError('Unknown overwrite policy {0}'.format(overwrite))
+
+
+def is_within_directory(directory, target, inclusive=False):
+    abs_directory = os.path.abspath(directory)
+    abs_target = os.path.abspath(target)
+    if inclusive and abs_target == abs_directory:
+        return True
+    return abs_target.startswith(os.path.join(abs_directory, ''))
+
+
+def write_output_file(fileobj, dest, overwrite=OVERWRITE_ASK, mode=None, skip_unchanged=False):
+    """
+    Write the contents of fileobj to dest, returning 'written', or 'unchanged'
+    or 'skipped' if dest was left alone
+
+    The data is written to a temp file alongside dest, which is then atomically
+    renamed into place; dest is never seen partially written. With
+    skip_unchanged, dest is left alone if its content is the same.
+    """
+    if check_overwrite(dest, overwrite) is False:
+        return 'skipped'
+
     # ensure destination dirs exist
     mkdir_p(os.path.dirname(dest))
 
-    # move file to output_dir
-    shutil.copy(path, dest)
+    fd, working_file = tempfile.mkstemp(prefix='.sesame-', dir=os.path.dirname(dest))
+    try:
+        with os.fdopen(fd, 'wb') as o:
+            while True:
+                data = fileobj.read(archive.CHUNK_SIZE)
+                if not data:
+                    break
+                with stats.phase('write output', len(data)):
+                    o.write(data)
+
+        if skip_unchanged and os.path.isfile(dest) and filecmp.cmp(working_file, dest, shallow=False):
+            os.remove(working_file)
+            return 'unchanged'
+
+        if mode is not None:
+            os.chmod(working_file, mode & 0o7777)
+
+        # rename over the destination; atomic on POSIX
+        os.rename(working_file, dest)
+        return 'written'
+
+    except:
+        os.remove(working_file)
+        raise
@@ -0,0 +1,265 @@
+from __future__ import absolute_import
+
+import fnmatch
+import json
+import os
+import tempfile
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from . import SesameError
+
+
+# colon-separated list of directories to search for keys, instead of the cwd
+SEARCH_PATH_ENV = 'SESAME_KEY_PATH'
+
+# path of the key discovery cache; set to an empty string to disable caching
+CACHE_ENV = 'SESAME_KEY_CACHE'
+CACHE_VERSION = 2
+
+# directories which are never searched for keys
+PRUNE_DIRS = frozenset([
+    '.git', '.hg', '.svn', '.bzr',
+    '.tox', '.nox', '.venv', 'venv', 'site-packages', 'node_modules', 'bower_components',
+    '__pycache__', '.mypy_cache', '.pytest_cache', '.ruff_cache',
+])
+
+# a directory containing any of these files is never searched (ie. a virtualenv)
+PRUNE_MARKERS = frozenset(['pyvenv.cfg'])
+
+# file of fnmatch patterns, one per line, excluded from the search beneath a root
+IGNORE_FILE = '.sesameignore'
+
+
+def get_search_path():
+    """
+    Return the directories to search for keys
+
+    These come from SESAME_KEY_PATH when set, otherwise the current directory.
+    """
+    value = os.environ.get(SEARCH_PATH_ENV)
+    if value:
+        return [os.path.abspath(path) for path in value.split(os.pathsep) if path]
+    return [os.getcwd()]
+
+
+def get_cache_path():
+    value = os.environ.get(CACHE_ENV)
+    if value is not None:
+        return value or None
+
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'sesame', 'keys.json')
+
+
+def find_keys(search_path=None, cache_path=None):
+    """
+    Locate sesame keys beneath each directory in search_path
+
+    Returns a list of (absolute path, key info) in the order found. The listing of
+    every directory searched, and the result of inspecting every candidate key,
+    is cached against mtimes; on a repeat run only directories which have changed
+    are listed again, and only new or modified keys are read.
+
+    search_path:
+        List of directories to search; defaults to get_search_path()
+    cache_path:
+        Path of the persistent cache; defaults to get_cache_path()
+    """
+    if search_path is None:
+        search_path = get_search_path()
+    if cache_path is None:
+        cache_path = get_cache_path()
+
+    cache = _load_cache(cache_path)
+    found = []
+
+    for root in search_path:
+        root = os.path.abspath(root)
+        finder = _KeyFinder(root, cache['roots'].get(root))
+        found.extend(finder.find())
+        cache['roots'][root] = finder.state
+
+    _save_cache(cache_path, cache)
+    return found
+
+
+class _KeyFinder(object):
+    """
+    Search a single root directory for keys, reusing cached state where valid
+    """
+    def __init__(self, root, state=None):
+        self.root = root
+        self.ignore_mtime = _mtime(os.path.join(root, IGNORE_FILE))
+        self.ignore = _read_ignore_file(os.path.join(root, IGNORE_FILE))
+
+        # the cache is only valid while the ignore rules remain unchanged
+        if state is None or state.get('ignore') != self.ignore_mtime:
+            state = {}
+
+        self.cached_dirs = state.get('dirs', {})
+        self.cached_keys = state.get('keys', {})
+        self.state = {'ignore': self.ignore_mtime, 'dirs': {}, 'keys': {}}
+
+    def find(self):
+        found = []
+
+        for relpath in self._walk():
+            path = os.path.join(self.root, relpath)
+            mtime = _mtime(path)
+            if mtime is None:
+                continue
+
+            info = self.cached_keys.get(relpath)
+            if info is None or info['mtime'] != mtime or info['size'] != os.path.getsize(path):
+                info = _inspect_key(path)
+                info['mtime'] = mtime
+                info['size'] = os.path.getsize(path)
+
+            self.state['keys'][relpath] = info
+            if info['valid']:
+                found.append((path, info))
+
+        return found
+
+    def _walk(self):
+        """
+        Yield the relative path of each candidate key beneath root, in the same
+        top-down order as os.walk
+        """
+        stack = ['']
+        while stack:
+            reldir = stack.pop()
+            mtime = _mtime(os.path.join(self.root, reldir))
+            if mtime is None:
+                continue
+
+            listing = self.cached_dirs.get(reldir)
+            if listing is None or listing['mtime'] != mtime:
+                listing = self._list_dir(reldir)
+                listing['mtime'] = mtime
+
+            self.state['dirs'][reldir] = listing
+
+            for filename in listing['keys']:
+                yield os.path.join(reldir, filename)
+
+            stack.extend(os.path.join(reldir, name) for name in reversed(listing['dirs']))
+
+    def _list_dir(self, reldir):
+        """
+        List the subdirectories and candidate keys in a directory, applying the
+        prune rules and ignore patterns
+        """
+        dirs, keys = [], []
+
+        try:
+            for name, is_dir in _scan(os.path.join(self.root, reldir)):
+                if name in PRUNE_MARKERS:
+                    return {'dirs': [], 'keys': []}
+
+                relpath = os.path.join(reldir, name)
+
+                if is_dir:
+                    if name not in PRUNE_DIRS and not self._ignored(relpath, is_dir=True):
+                        dirs.append(name)
+                elif fnmatch.fnmatch(name, '*.key') and not self._ignored(relpath):
+                    keys.append(name)
+
+        except OSError:
+            # unreadable directory
+            pass
+
+        return {'dirs': sorted(dirs), 'keys': sorted(keys)}
+
+    def _ignored(self, relpath, is_dir=False):
+        for pattern in self.ignore:
+            if pattern.endswith('/'):
+                if not is_dir:
+                    continue
+                pattern = pattern[:-1]
+
+            if fnmatch.fnmatch(relpath, pattern) or fnmatch.fnmatch(os.path.basename(relpath), pattern):
+                return True
+        return False
+
+
+def _scan(path):
+    """
+    Yield (name, is_dir) for each entry in a directory; symlinks are not followed
+    """
+    if scandir is not None:
+        for entry in scandir(path):
+            yield entry.name, entry.is_dir(follow_symlinks=False)
+    else:
+        for name in os.listdir(path):
+            full_path = os.path.join(path, name)
+            yield name, os.path.isdir(full_path) and not os.path.islink(full_path)
+
+
+def _inspect_key(path):
+    """
+    Read a candidate key file, recording whether it's a valid keyczar key and
+    its fingerprint
+    """
+    from .utils import read_key
+
+    try:
+        return {'valid': True, 'hash_id': read_key(path).hash_id}
+    except (ValueError, KeyError, SesameError):
+        # non-keyczar files will error
+        return {'valid': False}
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _read_ignore_file(path):
+    try:
+        with open(path) as f:
+            lines = [line.strip() for line in f]
+    except IOError:
+        return []
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def _load_cache(cache_path):
+    cache = None
+    if cache_path is not None:
+        try:
+            with open(cache_path) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    if not isinstance(cache, dict) or cache.get('version') != CACHE_VERSION:
+        cache = {'version': CACHE_VERSION, 'roots': {}}
+    return cache
+
+
+def _save_cache(cache_path, cache):
+    if cache_path is None:
+        return
+
+    # the cache is an optimisation only; never fail because it can't be written
+    try:
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+
+        fd, working_file = tempfile.mkstemp(prefix='.keys-', dir=os.path.dirname(cache_path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f)
+        os.rename(working_file, cache_path)
+
+    except (IOError, OSError):
+        pass
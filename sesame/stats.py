@@ -0,0 +1,132 @@
+from __future__ import absolute_import
+
+import collections
+import contextlib
+import json
+import threading
+import time
+
+
+# callbacks notified as each phase completes, and the active collectors
+_hooks = []
+_collectors = []
+
+
+def add_hook(callback):
+    """
+    Call callback(phase, seconds, nbytes) each time a phase of work completes
+
+    With jobs > 1 phases complete in worker threads, so callback must be
+    thread-safe.
+    """
+    _hooks.append(callback)
+
+
+def remove_hook(callback):
+    _hooks.remove(callback)
+
+
+def record(name, seconds, nbytes=0):
+    """
+    Report a completed phase to every hook and collector
+    """
+    for callback in _hooks + _collectors:
+        callback(name, seconds, nbytes)
+
+
+def phase(name, nbytes=0):
+    """
+    Return a context manager which times the enclosed block as one occurrence
+    of phase name
+
+    If the number of bytes processed is only known within the block, set nbytes
+    on the object returned. Nothing is timed unless a hook or collector is active.
+    """
+    return _Phase(name, nbytes)
+
+
+class _Phase(object):
+    __slots__ = ('name', 'nbytes', 'start')
+
+    def __init__(self, name, nbytes):
+        self.name = name
+        self.nbytes = nbytes
+        self.start = None
+
+    def __enter__(self):
+        if _hooks or _collectors:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            record(self.name, time.time() - self.start, self.nbytes)
+
+
+@contextlib.contextmanager
+def collect():
+    """
+    Collect totals for each phase of the work done within the block
+
+        with sesame.stats.collect() as stats:
+            encrypt(...)
+        print stats.format()
+    """
+    stats = Stats()
+    _collectors.append(stats)
+    start = time.time()
+    try:
+        yield stats
+    finally:
+        stats.seconds = time.time() - start
+        _collectors.remove(stats)
+
+
+class Stats(object):
+    """
+    Totals of the calls, duration and bytes of each phase, in the order each
+    phase was first seen, plus the overall wall time
+
+    Phases which run concurrently in worker threads each contribute their own
+    duration, so the sum of the phases can exceed the wall time.
+    """
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self.seconds = None
+        self._lock = threading.Lock()
+
+    def __call__(self, name, seconds, nbytes):
+        with self._lock:
+            totals = self.phases.get(name)
+            if totals is None:
+                totals = self.phases[name] = {'calls': 0, 'seconds': 0.0, 'bytes': 0}
+            totals['calls'] += 1
+            totals['seconds'] += seconds
+            totals['bytes'] += nbytes
+
+    def as_dict(self):
+        return {
+            'seconds': self.seconds,
+            'phases': collections.OrderedDict(
+                (name, dict(totals)) for name, totals in self.phases.items()
+            ),
+        }
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, separators=(',', ': '))
+
+    def format(self):
+        lines = ['{0:<16} {1:>8} {2:>10} {3:>14} {4:>10}'.format(
+            'phase', 'calls', 'seconds', 'bytes', 'MB/s'
+        )]
+        for name, totals in self.phases.items():
+            if totals['bytes'] and totals['seconds']:
+                rate = '{0:.2f}'.format(totals['bytes'] / 1048576.0 / totals['seconds'])
+            else:
+                rate = '-'
+            lines.append('{0:<16} {1[calls]:>8} {1[seconds]:>10.4f} {1[bytes]:>14} {2:>10}'.format(
+                name, totals, rate
+            ))
+        lines.append('{0:<16} {1:>8} {2:>10.4f}'.format('total', '', self.seconds or 0))
+        return '\n'.join(lines) + '\n'
@@ -1,11 +1,8 @@
 from __future__ import absolute_import
 
-import codecs
 import collections
 import contextlib
 import errno
-import fnmatch
-import json
 import os
 import shutil
 import tempfile
@@ -13,13 +10,25 @@ import tempfile
 from keyczar.keys import AesKey
 
 from . import SesameError
-from . import MODE_ENCRYPT, MODE_DECRYPT
+from . import stats
+from . import MODE_ENCRYPT, MODE_DECRYPT, MODE_LIST, MODE_REKEY
+from .agent import select_agent_keys
+from .discovery import find_keys
+
+
+# keys parsed by read_key, memoized for the process
+_parsed_keys = {}
 
 
 def get_keys(args):
     """
     Get the set of keys to be used for this encrypt/decrypt
     """
+    # keys held by a running agent are already parsed
+    keys = select_agent_keys(args.keyfile, args.mode)
+    if keys is not None:
+        return keys
+
     keys = []
 
     if args.keyfile is None:
@@ -33,7 +42,7 @@ def get_keys(args):
                 keys = [key]
 
         elif len(keys) >= 1:
-            if args.mode == MODE_ENCRYPT or (args.mode == MODE_DECRYPT and args.try_all is False):
+            if args.mode == MODE_ENCRYPT or (args.mode in (MODE_DECRYPT, MODE_LIST, MODE_REKEY) and args.try_all is False):
                 # ask the user if they want to use the first key found
                 if confirm("No key supplied and {0} found. Use '{1}'?".format(
                     len(keys), keys.keys()[0]
@@ -55,38 +64,31 @@ def get_keys(args):
             # use the only key found
             keys = [keys.items()[0][1]]
     else:
-        # create a key
-        if os.path.exists(args.keyfile) is False:
-            key = ask_create_key()
-            if key is not None:
-                keys = [key]
-        else:
-            # load the single key supplied
-            key = read_key(os.path.join(args.keyfile))
-            if key is not None:
-                keys = [key]
+        for keyfile in args.keyfile:
+            # create a key
+            if os.path.exists(keyfile) is False:
+                key = ask_create_key()
+                if key is not None:
+                    keys.append(key)
+            else:
+                # each key supplied is loaded on first use
+                keys.append(KeyHandle(keyfile))
 
     return keys
 
 
-def find_sesame_keys():
+def find_sesame_keys(search_path=None):
+    """
+    Locate sesame keys beneath the search path (by default the current directory)
+
+    Returns an OrderedDict of path relative to the current directory => KeyHandle
+    """
     # use OrderedDict to maintain order in which keys are found
     keys = collections.OrderedDict()
-    for root, dirs, files in os.walk(os.getcwd()):
-        for filename in fnmatch.filter(files, '*.key'):
-            try:
-                # attempt to read the sesame key; non-keyczar files will error
-                key = read_key(os.path.join(root, filename))
-
-                # generate a relative path to the key from current working dir
-                relative_path = root[len(os.getcwd()):]
-                if relative_path.startswith(os.path.sep):
-                    relative_path = relative_path[1:]
-
-                keys[os.path.join(relative_path, filename)] = key
-
-            except (ValueError, KeyError):
-                pass
+    with stats.phase('discover keys'):
+        for path, info in find_keys(search_path):
+            # keys are parsed only when used
+            keys[os.path.relpath(path)] = KeyHandle(path, info.get('hash_id'))
     return keys
 
 
@@ -96,6 +98,10 @@ def verify_input_files(inputfiles):
         inputfiles = [inputfiles]
 
     for f in inputfiles:
+        # stdin is checked as it's read
+        if f == '-':
+            continue
+
         # fail if input file doesn't exist
         if not os.path.exists(f):
             raise SesameError('File doesn\'t exist at {0}'.format(f))
@@ -109,25 +115,81 @@ def verify_input_files(inputfiles):
 
 
 def read_key(key_path):
-    # attempt decode key with various codecs
-    for codec in ('utf-8', 'latin1', 'utf-8-sig'):
-        try:
-            with codecs.open(key_path, 'rU', encoding=codec) as f:
-                key = f.read()
-                json.loads(key)
+    """
+    Read and parse a keyczar AES key
+
+    Parsed keys are memoized for the life of the process against the file's
+    path, size and mtime, so each key file is parsed at most once.
+    """
+    try:
+        with open(key_path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            cache_key = (os.path.realpath(key_path), stat.st_size, stat.st_mtime)
+            if cache_key in _parsed_keys:
+                return _parsed_keys[cache_key]
+
+            data = f.read()
+
+    except IOError, e:
+        raise SesameError('Problem opening keyfile {0}: {1}'.format(key_path, e))
+
+    # attempt decode key with various codecs; utf-8-sig also handles plain utf-8
+    with stats.phase('read key', len(data)):
+        for codec in ('utf-8-sig', 'latin1'):
+            try:
+                # pass correctly decoded key data to keyczar
+                key = AesKey.Read(data.decode(codec))
                 break
 
-        except (UnicodeDecodeError, ValueError), e:
-            # retry with alternate codec
-            continue
-        except IOError, e:
-            raise SesameError('Problem opening keyfile {0}: {1}'.format(key_path, e))
+            except ValueError, e:
+                # retry with alternate codec
+                continue
+        else:
+            raise e
 
-    if key is None:
-        raise SesameError("Could not decode keyfile")
+    _parsed_keys[cache_key] = key
+    return key
 
-    # pass correctly decoded key data to keyczar
-    return AesKey.Read(key)
+
+class KeyHandle(object):
+    """
+    A key file which is only read and parsed when it's first used
+
+    The fingerprint (keyczar hash_id) may be supplied up front, for example from
+    the key discovery cache. All other attributes are passed through to the
+    parsed AesKey, so a handle can be used anywhere a key is expected.
+    """
+    def __init__(self, path, hash_id=None):
+        self.path = path
+        self._hash_id = hash_id
+        self._key = None
+
+    def __repr__(self):
+        return '<KeyHandle {0}>'.format(self.path)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.key, name)
+
+    @property
+    def loaded(self):
+        return self._key is not None
+
+    @property
+    def key(self):
+        if self._key is None:
+            try:
+                self._key = read_key(self.path)
+            except (ValueError, KeyError):
+                raise SesameError('Invalid keyfile {0}'.format(self.path))
+        return self._key
+
+    @property
+    def hash_id(self):
+        if self._hash_id is None:
+            self._hash_id = self.key.hash_id
+        return self._hash_id
 
 
 def ask_create_key(directory=os.getcwd()):
@@ -38,6 +38,7 @@ setup(
     package_dir={'': '.'},
     include_package_data=True,
     install_requires=requires,
+    extras_require={'aio': ['trollius', 'futures']},
     scripts=['scripts/sesame'],
     license=open('LICENSE').read(),
     classifiers=(
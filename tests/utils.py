@@ -2,6 +2,7 @@ import contextlib
 import errno
 import os
 import shutil
+import StringIO
 
 
 @contextlib.contextmanager
@@ -36,6 +37,18 @@ def delete_path(path):
         os.remove(path)
 
 
+class Pipe(object):
+    """ A stream which can only be read, like stdin when it's a pipe """
+    def __init__(self, data):
+        self._data = StringIO.StringIO(data)
+
+    def read(self, size=-1):
+        return self._data.read(size)
+
+    def seek(self, offset, whence=0):
+        raise IOError('Illegal seek')
+
+
 def _get_path_base(path):
     """
     Reduce a path to it's base element